@@ -0,0 +1,198 @@
+import sys
+import os
+import time
+import argparse
+import json
+import random
+import shutil
+import subprocess
+
+from main_cli import get_ffmpeg_binary
+
+# Бенчмарк рендера на синтетических исходниках: тестовые видео и тон генерирует ffmpeg (lavfi), субтитры .ass - этот скрипт.
+# Каждая конфигурация запускается как обычный main_cli.py с --profile, отчеты профилирования собираются в одну таблицу.
+
+MAIN_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main_cli.py")
+DEFAULT_WORK_DIR = ".montage_bench"
+DEFAULT_EVENT_COUNTS = "10,1000,10000"
+
+# Видеопаттерны lavfi: разная сложность кадра для кодировщика
+SOURCE_PATTERNS = ["testsrc2", "smptehdbars", "testsrc", "rgbtestsrc"]
+
+BENCH_CONFIGS = {
+    "moviepy": ["--backend", "moviepy"],
+    "moviepy_noprefetch": ["--backend", "moviepy", "--prefetch_threads", "0"],
+    "ffmpeg": ["--backend", "ffmpeg"],
+    "ffmpeg_chunks2": ["--backend", "ffmpeg", "--chunks", "2"],
+    "ffmpeg_proxies": ["--backend", "ffmpeg", "--proxies"],
+}
+DEFAULT_CONFIGS = "moviepy,ffmpeg,ffmpeg_chunks2"
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {w}
+PlayResY: {h}
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,2,1,2,10,10,30,1
+Style: Top,Arial,36,&H0000FFFF,&H000000FF,&H00202020,&H80000000,-1,0,0,0,100,100,0,0,1,3,0,8,10,10,30,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+WORDS = "быстрый монтаж по субтитрам кадр звук текст видео сцена план шаг ритм свет тень город море небо".split()
+
+def ass_time(t):
+    cs = int(round(t * 100)); h, cs = divmod(cs, 360000); m, cs = divmod(cs, 6000); s, cs = divmod(cs, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+def write_ass_file(path, n_events, event_duration, size, seed=0):
+    # Строки повторяются (как в реальных пакетах), часть событий - в две строки (\N)
+    rng = random.Random(seed); phrases = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) for _ in range(max(1, n_events // 4))]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(ASS_HEADER.format(w=size[0], h=size[1]))
+        for i in range(n_events):
+            t0 = i * event_duration; text = rng.choice(phrases)
+            if rng.random() < 0.2: text += "\\N" + rng.choice(phrases)
+            f.write(f"Dialogue: 0,{ass_time(t0)},{ass_time(t0 + event_duration)},{'Top' if i % 5 == 4 else 'Default'},,0,0,0,,{text}\n")
+
+def run_ffmpeg(args):
+    cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error"] + args
+    proc = subprocess.run(cmd)
+    if proc.returncode != 0: sys.exit(f"Ошибка ffmpeg (код {proc.returncode}): {' '.join(cmd)}")
+
+def generate_sources(work_dir, n_videos, video_duration, size, fps, audio_duration):
+    # Генерируются один раз: повторный запуск бенчмарка использует те же файлы
+    video_dir = os.path.join(work_dir, "videos"); audio_dir = os.path.join(work_dir, "audio")
+    os.makedirs(video_dir, exist_ok=True); os.makedirs(audio_dir, exist_ok=True)
+    for k in range(n_videos):
+        pattern = SOURCE_PATTERNS[k % len(SOURCE_PATTERNS)]
+        path = os.path.join(video_dir, f"src_{k:02d}_{pattern}_{size[0]}x{size[1]}_{fps}.mp4")
+        if os.path.exists(path): continue
+        print(f"Генерация видео: {path}")
+        run_ffmpeg(["-f", "lavfi", "-i", f"{pattern}=size={size[0]}x{size[1]}:rate={fps}", "-t", str(video_duration),
+                    "-c:v", "libx264", "-preset", "veryfast", "-g", str(fps * 2), "-pix_fmt", "yuv420p", path + ".tmp.mp4"])
+        os.replace(path + ".tmp.mp4", path)
+    audio_path = os.path.join(audio_dir, f"tone_{audio_duration}s.wav")
+    if not os.path.exists(audio_path):
+        print(f"Генерация аудио: {audio_path}")
+        run_ffmpeg(["-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={audio_duration}", "-ac", "2", audio_path + ".tmp.wav"])
+        os.replace(audio_path + ".tmp.wav", audio_path)
+    return video_dir, audio_dir
+
+def run_benchmark_case(config_name, n_events, ass_path, video_dir, audio_dir, work_dir, args):
+    case_dir = os.path.join(work_dir, "runs", f"{config_name}_{n_events}")
+    cache_dir = os.path.join(work_dir, "cache") if args.warm_cache else os.path.join(case_dir, "cache")
+    shutil.rmtree(case_dir, ignore_errors=True); os.makedirs(case_dir)
+    cmd = [sys.executable, MAIN_CLI, "-vd", video_dir, "-ad", audio_dir, "-sub", ass_path, "-od", case_dir, "-n", str(args.num_montages),
+           "-max_dur", str(args.max_duration), "--seed", str(args.seed), "--profile", "--overwrite", "--cache_dir", cache_dir] + BENCH_CONFIGS[config_name]
+    start_time = time.perf_counter()
+    with open(os.path.join(case_dir, "log.txt"), 'w', encoding='utf-8') as log: proc = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start_time
+    reports = []
+    for f_name in sorted(os.listdir(case_dir)):
+        if f_name.endswith(".profile.json"):
+            with open(os.path.join(case_dir, f_name), 'r', encoding='utf-8') as f: reports.append(json.load(f))
+    plan_report_path = os.path.join(case_dir, "edl", "plan.profile.json")
+    plan_report = None
+    if os.path.exists(plan_report_path):
+        with open(plan_report_path, 'r', encoding='utf-8') as f: plan_report = json.load(f)
+    ok = proc.returncode == 0 and len(reports) == args.num_montages and all(r["success"] for r in reports)
+    stages = {}
+    for r in reports + ([plan_report] if plan_report else []):
+        for name, st in r["stages"].items(): stages[name] = stages.get(name, 0.0) + st["wall"]
+    frames = sum(r["frames"] for r in reports)
+    render_wall = sum(r["wall_total"] for r in reports)
+    rss = [r["peak_rss_mb"] for r in reports if r.get("peak_rss_mb") is not None]
+    return {"config": config_name, "events": n_events, "ok": ok, "wall": round(wall, 3), "render_wall": round(render_wall, 3), "frames": frames,
+            "fps": round(frames / render_wall, 2) if render_wall > 0 else None, "stages": {k: round(v, 4) for k, v in stages.items()},
+            "ffmpeg_processes": sum(r["processes"].get("ffmpeg", 0) for r in reports),
+            "peak_rss_mb": max(rss) if rss else None,
+            "log": os.path.join(case_dir, "log.txt")}
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Регрессия: полное время случая выросло больше чем на tolerance относительно базового замера
+    base = {(r["config"], r["events"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        b = base.get((r["config"], r["events"]))
+        if not b or not r["ok"] or not b.get("ok"): continue
+        ratio = r["wall"] / b["wall"] if b["wall"] > 0 else 1.0
+        r["baseline_wall"] = b["wall"]; r["ratio"] = round(ratio, 3)
+        if ratio > 1.0 + tolerance: regressions.append(r)
+    return regressions
+
+def print_results(results):
+    print(f"\n{'конфигурация':<20} {'событий':>8} {'время':>8} {'рендер':>8} {'кадр/с':>8} {'ffmpeg':>7} {'RSS МБ':>8} {'к базе':>7}")
+    for r in results:
+        status = "" if r["ok"] else "  ОШИБКА (" + r["log"] + ")"
+        ratio = f"{r['ratio']:.2f}x" if "ratio" in r else "-"
+        print(f"{r['config']:<20} {r['events']:>8} {r['wall']:>8.2f} {r['render_wall']:>8.2f} {r['fps'] or 0:>8.1f} {r['ffmpeg_processes']:>7} {r['peak_rss_mb'] or 0:>8.1f} {ratio:>7}{status}")
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера main_cli.py на синтетических исходниках.")
+    parser.add_argument("--work_dir", default=DEFAULT_WORK_DIR, help=f"Папка для исходников, прогонов и результатов (по умолч. {DEFAULT_WORK_DIR}).")
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS, help=f"Конфигурации через запятую из: {', '.join(BENCH_CONFIGS)} (по умолч. {DEFAULT_CONFIGS}).")
+    parser.add_argument("--events", default=DEFAULT_EVENT_COUNTS, help=f"Число событий в сгенерированных .ass через запятую (по умолч. {DEFAULT_EVENT_COUNTS}).")
+    parser.add_argument("--event_duration", type=float, default=1.5, help="Длительность одного события субтитров, сек.")
+    parser.add_argument("-max_dur", "--max_duration", type=int, default=20, help="Ограничение длительности монтажа (сек): большие .ass нагружают разбор и планирование, а не кодирование.")
+    parser.add_argument("-n", "--num_montages", type=int, default=1, help="Монтажей на один прогон.")
+    parser.add_argument("--videos", type=int, default=3, help="Сколько исходных видео сгенерировать.")
+    parser.add_argument("--video_duration", type=int, default=30, help="Длительность исходного видео, сек.")
+    parser.add_argument("--size", default="1280x720", help="Размер исходных видео (ШxВ).")
+    parser.add_argument("--fps", type=int, default=30, help="FPS исходных видео.")
+    parser.add_argument("--seed", type=int, default=1, help="Сид main_cli.py: одинаковые планы во всех прогонах.")
+    parser.add_argument("--repeat", type=int, default=1, help="Повторить каждый случай N раз и взять лучший результат.")
+    parser.add_argument("--warm_cache", action="store_true", help="Общий --cache_dir для всех прогонов (по умолч. у каждого прогона свой пустой кэш).")
+    parser.add_argument("--baseline", default=None, help="JSON с результатами прошлого запуска: сравнить и вернуть код 1 при регрессии.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Допустимое замедление относительно базы (доля, по умолч. 0.15).")
+    parser.add_argument("--save", default=None, help="Куда сохранить результаты (по умолч. <work_dir>/results.json).")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    configs = [c.strip() for c in args.configs.split(",") if c.strip()]
+    unknown = [c for c in configs if c not in BENCH_CONFIGS]
+    if unknown: sys.exit(f"Неизвестные конфигурации: {', '.join(unknown)}")
+    event_counts = [int(x) for x in args.events.split(",") if x.strip()]
+    size = tuple(int(x) for x in args.size.lower().split("x"))
+
+    work_dir = os.path.abspath(args.work_dir); os.makedirs(work_dir, exist_ok=True)
+    audio_duration = max(5, args.max_duration // 2) # Короче монтажа: проверяется и зацикливание музыки
+    video_dir, audio_dir = generate_sources(work_dir, args.videos, args.video_duration, size, args.fps, audio_duration)
+    ass_paths = {}
+    for n_events in event_counts:
+        ass_paths[n_events] = os.path.join(work_dir, "subs", f"bench_{n_events}.ass")
+        if not os.path.exists(ass_paths[n_events]):
+            os.makedirs(os.path.dirname(ass_paths[n_events]), exist_ok=True)
+            write_ass_file(ass_paths[n_events], n_events, args.event_duration, size, seed=n_events)
+
+    results = []
+    for config_name in configs:
+        for n_events in event_counts:
+            best = None
+            for attempt in range(max(1, args.repeat)):
+                print(f"Прогон: {config_name}, событий {n_events} ({attempt + 1}/{args.repeat})...")
+                res = run_benchmark_case(config_name, n_events, ass_paths[n_events], video_dir, audio_dir, work_dir, args)
+                if best is None or (res["ok"] and (not best["ok"] or res["wall"] < best["wall"])): best = res
+            results.append(best)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f: regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+    print_results(results)
+    save_path = args.save or os.path.join(work_dir, "results.json")
+    with open(save_path, 'w', encoding='utf-8') as f:
+        json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "argv": sys.argv[1:], "cpu_count": os.cpu_count(), "results": results}, f, ensure_ascii=False, indent=1)
+    print(f"Результаты: {save_path}")
+    failed = [r for r in results if not r["ok"]]
+    if failed: print(f"Ошибки в прогонах: {len(failed)}")
+    if regressions:
+        print(f"РЕГРЕССИЯ (медленнее базы более чем на {args.tolerance:.0%}):")
+        for r in regressions: print(f"  {r['config']}, событий {r['events']}: {r['wall']:.2f} сек. против {r['baseline_wall']:.2f} сек.")
+    if failed or regressions: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -7,43 +7,137 @@ import time
 import argparse
 import random
 import re # Для парсинга ASS
+import json
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import math
+import shutil
+import subprocess
+import tempfile
+import threading
+import queue
+import collections
+import signal
+import contextlib
+import array
+import bisect
+import itertools
 
 # Игнорирование предупреждений
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-try:
-    import librosa 
-except ImportError as e:
-    print(f"Ошибка импорта librosa: {e}\nУстановите: pip install librosa")
-    sys.exit(1)
+# moviepy.editor грузится лениво (load_moviepy): он нужен только бэкенду moviepy, а клиенту демона, --plan_only и бэкенду ffmpeg - нет
+mp = None
+
+def load_moviepy():
+    global mp
+    if mp is None:
+        try: import moviepy.editor as mp_editor
+        except ImportError as e:
+            print(f"Ошибка импорта moviepy: {e}\nУстановите: pip install moviepy==1.0.3")
+            sys.exit(1)
+        mp = mp_editor
+    return mp
 
 try:
-    import moviepy.editor as mp
-    import moviepy.video.fx.all as vfx 
-    from moviepy.config import get_setting # Для проверки ImageMagick
+    from PIL import Image, ImageDraw, ImageFont # Растеризация текста субтитров
 except ImportError as e:
-    print(f"Ошибка импорта moviepy: {e}\nУстановите: pip install moviepy==1.0.3")
+    print(f"Ошибка импорта Pillow: {e}\nУстановите: pip install Pillow")
     sys.exit(1)
 
-# --- Проверка ImageMagick при запуске ---
-IMAGEMAGICK_DEFAULT_BINARY_PATH = "" # Глобальная переменная для хранения пути
-try:
-    IMAGEMAGICK_DEFAULT_BINARY_PATH = get_setting('IMAGEMAGICK_BINARY')
-    print(f"ImageMagick Binary (MoviePy setting): {IMAGEMAGICK_DEFAULT_BINARY_PATH}")
-    if not os.path.exists(IMAGEMAGICK_DEFAULT_BINARY_PATH):
-        print(f"ПРЕДУПРЕЖДЕНИЕ: Файл ImageMagick не найден по пути из конфигурации: {IMAGEMAGICK_DEFAULT_BINARY_PATH}")
-        print("  MoviePy может не работать корректно с TextClip.")
-        IMAGEMAGICK_DEFAULT_BINARY_PATH = "" # Сбрасываем, если путь невалиден
-except KeyError:
-    print("ПРЕДУПРЕЖДЕНИЕ: IMAGEMAGICK_BINARY не определен в конфигурации MoviePy.")
-    print("  Убедитесь, что ImageMagick установлен (с legacy utilities и добавлен в PATH).")
-    print("  MoviePy может не найти ImageMagick, что вызовет проблемы с TextClip.")
-    print("  Если ImageMagick установлен, но не находится, создайте moviepy/config.py")
-    print("  из moviepy/config_defaults.py и укажите там IMAGEMAGICK_BINARY (например, путь к magick.exe или convert.exe).")
-except Exception as e_imagick_check:
-    print(f"Ошибка при проверке конфигурации ImageMagick: {e_imagick_check}")
+# --- Проверка ImageMagick (только для --text_renderer imagemagick, один раз на процесс) ---
+@functools.lru_cache(maxsize=None)
+def check_imagemagick():
+    imagemagick_binary = "" # Путь к ImageMagick из конфигурации MoviePy
+    try:
+        from moviepy.config import get_setting
+        imagemagick_binary = get_setting('IMAGEMAGICK_BINARY')
+        print(f"ImageMagick Binary (MoviePy setting): {imagemagick_binary}")
+        if not os.path.exists(imagemagick_binary):
+            print(f"ПРЕДУПРЕЖДЕНИЕ: Файл ImageMagick не найден по пути из конфигурации: {imagemagick_binary}")
+            print("  MoviePy может не работать корректно с TextClip.")
+            imagemagick_binary = "" # Сбрасываем, если путь невалиден
+    except KeyError:
+        print("ПРЕДУПРЕЖДЕНИЕ: IMAGEMAGICK_BINARY не определен в конфигурации MoviePy.")
+        print("  Убедитесь, что ImageMagick установлен (с legacy utilities и добавлен в PATH).")
+        print("  MoviePy может не найти ImageMagick, что вызовет проблемы с TextClip.")
+        print("  Если ImageMagick установлен, но не находится, создайте moviepy/config.py")
+        print("  из moviepy/config_defaults.py и укажите там IMAGEMAGICK_BINARY (например, путь к magick.exe или convert.exe).")
+    except Exception as e_imagick_check:
+        print(f"Ошибка при проверке конфигурации ImageMagick: {e_imagick_check}")
+    return imagemagick_binary
+
+
+# --- Профилирование (--profile): время стадий (wall/CPU), пик памяти, число запущенных ffmpeg/ffprobe ---
+try: import resource # Нет в Windows: там отчет без пиковой памяти
+except ImportError: resource = None
+
+_ACTIVE_PROFILER = None
+
+def _cpu_times():
+    t = os.times()
+    return t.user + t.system, t.children_user + t.children_system # CPU дочерних процессов (ffmpeg) учитывается после их завершения
+
+def _peak_rss_mb(who):
+    if resource is None: return None
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024.0 ** 2 if sys.platform == "darwin" else 1024.0), 1) # macOS - байты, Linux - КБ
+
+class StageProfiler:
+    def __init__(self):
+        self.stages = collections.OrderedDict(); self.counters = collections.Counter()
+        self.wall0 = time.perf_counter(); self.cpu0 = _cpu_times()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall0 = time.perf_counter(); cpu0 = _cpu_times()
+        try: yield
+        finally:
+            cpu1 = _cpu_times(); st = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "cpu_children": 0.0, "calls": 0})
+            st["wall"] += time.perf_counter() - wall0; st["cpu"] += cpu1[0] - cpu0[0]; st["cpu_children"] += cpu1[1] - cpu0[1]; st["calls"] += 1
+
+    def add_report(self, reports, prefix):
+        # Стадии из других процессов (куски --chunks): время суммируется по всем процессам
+        for rep in reports:
+            for name, st in rep["stages"].items():
+                dst = self.stages.setdefault(prefix + name, {"wall": 0.0, "cpu": 0.0, "cpu_children": 0.0, "calls": 0})
+                for k in dst: dst[k] += st[k]
+            self.counters.update(rep["processes"])
 
+    def report(self, **extra):
+        cpu1 = _cpu_times()
+        rep = {"wall_total": round(time.perf_counter() - self.wall0, 4), "cpu_total": round(cpu1[0] - self.cpu0[0], 4), "cpu_children_total": round(cpu1[1] - self.cpu0[1], 4),
+               "stages": {name: {k: (round(v, 4) if isinstance(v, float) else v) for k, v in st.items()} for name, st in self.stages.items()},
+               "processes": dict(self.counters),
+               "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF) if resource else None, # Пик за жизнь процесса, не только за этот монтаж
+               "peak_rss_children_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None}
+        rep.update(extra)
+        return rep
+
+class _CountingPopen(subprocess.Popen):
+    # Подменяет subprocess.Popen: так считаются и процессы, которые запускают moviepy и ffmpeg-python
+    def __init__(self, args, *popen_args, **popen_kwargs):
+        profiler = _ACTIVE_PROFILER
+        if profiler is not None:
+            prog = os.path.basename(str(args[0] if isinstance(args, (list, tuple)) else args).split(" ")[0]).lower()
+            profiler.counters["ffprobe" if "ffprobe" in prog else "ffmpeg" if "ffmpeg" in prog else "other"] += 1
+        super().__init__(args, *popen_args, **popen_kwargs)
+
+@contextlib.contextmanager
+def profiling(profiler):
+    # profiling(None) ничего не делает - вызовы profile_stage() без --profile почти бесплатны
+    global _ACTIVE_PROFILER
+    if profiler is None: yield None; return
+    prev_popen = subprocess.Popen; subprocess.Popen = _CountingPopen # Подмена только на время профилирования (в --serve процесс живет дальше)
+    prev = _ACTIVE_PROFILER; _ACTIVE_PROFILER = profiler
+    try: yield profiler
+    finally: _ACTIVE_PROFILER = prev; subprocess.Popen = prev_popen
+
+def profile_stage(name):
+    return _ACTIVE_PROFILER.stage(name) if _ACTIVE_PROFILER is not None else contextlib.nullcontext()
 
 def parse_ass_time(time_str):
     try:
@@ -52,23 +146,103 @@ def parse_ass_time(time_str):
         return int(h) * 3600 + int(m) * 60 + int(s) + int(cs) / 100.0
     except ValueError: print(f"Ошибка парсинга времени из ASS: '{time_str}'"); return 0.0
 
+# --- Субтитры: потоковый разбор .ass в компактную дорожку событий ---
+ASS_EVENT_FIELDS = ["layer", "start", "end", "style", "name", "marginl", "marginr", "marginv", "effect", "text"] # Если в [Events] нет строки Format
+
+class SubtitleTrack:
+    # События хранятся столбцами: начало/конец - array('d'), стиль и текст - номера в таблицах уникальных значений
+    # (в пословных дорожках одни и те же слова повторяются тысячи раз). Итерация и индексация отдают словари
+    # {start, end, duration, style_name, text}, как прежний список событий; отсечка по времени (count_before) - через bisect.
+    def __init__(self):
+        self.starts = array.array('d'); self.ends = array.array('d'); self.style_ids = array.array('I'); self.text_ids = array.array('I')
+        self.style_names = []; self.texts = []; self.is_sorted = True
+        self._style_index = {}; self._text_index = {}; self._plain_texts = {}
+
+    def append(self, start, end, style_name, text):
+        style_id = self._style_index.get(style_name)
+        if style_id is None: style_id = self._style_index[style_name] = len(self.style_names); self.style_names.append(style_name)
+        text_id = self._text_index.get(text)
+        if text_id is None: text_id = self._text_index[text] = len(self.texts); self.texts.append(text)
+        if self.starts and start < self.starts[-1]: self.is_sorted = False
+        self.starts.append(start); self.ends.append(end); self.style_ids.append(style_id); self.text_ids.append(text_id)
+
+    def finish(self):
+        # Сортируем, только если файл не упорядочен по началу (порядок равных сохраняется, как у list.sort)
+        if not self.is_sorted:
+            order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+            for name in ("starts", "ends", "style_ids", "text_ids"):
+                col = getattr(self, name); setattr(self, name, array.array(col.typecode, (col[i] for i in order)))
+            self.is_sorted = True
+        self._style_index = {}; self._text_index = {} # После разбора таблицы только читаются
+        return self
+
+    def __len__(self): return len(self.starts)
+
+    def __getitem__(self, i):
+        start, end = self.starts[i], self.ends[i]
+        return {"start": start, "end": end, "duration": end - start, "style_name": self.style_names[self.style_ids[i]], "text": self.texts[self.text_ids[i]]}
+
+    def __iter__(self): return (self[i] for i in range(len(self)))
+
+    def count_before(self, t):
+        # Сколько событий начинается раньше t
+        return bisect.bisect_left(self.starts, t)
+
+    def plain_text(self, i):
+        # Текст без тегов {...}, по одному разбору на уникальную строку
+        text_id = self.text_ids[i]
+        if text_id not in self._plain_texts: self._plain_texts[text_id] = re.sub(r"\{[^}]*\}", "", self.texts[text_id])
+        return self._plain_texts[text_id]
+
+    def to_dict(self):
+        return {"starts": self.starts.tolist(), "ends": self.ends.tolist(), "style_ids": self.style_ids.tolist(), "text_ids": self.text_ids.tolist(),
+                "style_names": self.style_names, "texts": self.texts}
+
+    @classmethod
+    def from_dict(cls, data):
+        track = cls()
+        track.starts = array.array('d', data["starts"]); track.ends = array.array('d', data["ends"])
+        track.style_ids = array.array('I', data["style_ids"]); track.text_ids = array.array('I', data["text_ids"])
+        track.style_names = data["style_names"]; track.texts = data["texts"]
+        track.is_sorted = all(a <= b for a, b in zip(track.starts, itertools.islice(track.starts, 1, None)))
+        return track.finish()
+
 def parse_ass_file(filepath):
-    events = []; styles = {} 
-    if not os.path.exists(filepath): print(f"Файл субтитров не найден: {filepath}"); return events, styles
-    dialogue_pattern = re.compile(r"Dialogue:\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*([^,]*),\s*(.*)")
-    in_events_section = False; in_styles_section = False; style_field_names = [] 
+    track = SubtitleTrack(); styles = {}
+    if not os.path.exists(filepath): print(f"Файл субтитров не найден: {filepath}"); return track.finish(), styles
+    in_events_section = False; in_styles_section = False; style_field_names = []
+    event_fields = ASS_EVENT_FIELDS; skipped_events = 0; time_cache = {}
+    i_start, i_end, i_style = (event_fields.index(name) for name in ("start", "end", "style"))
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
             for line_num, line in enumerate(f, 1):
                 line = line.strip()
+                # Быстрый путь для Dialogue: поля режутся split по первым запятым (текст - последнее поле и может содержать запятые)
+                if in_events_section and line[:9].lower() == "dialogue:":
+                    fields = line[9:].split(',', len(event_fields) - 1)
+                    if len(fields) < len(event_fields): skipped_events += 1; continue
+                    try:
+                        s, e_time = time_cache.get(fields[i_start]), time_cache.get(fields[i_end]) # Конец события обычно равен началу следующего
+                        if s is None: s = time_cache[fields[i_start]] = parse_ass_time(fields[i_start].strip())
+                        if e_time is None: e_time = time_cache[fields[i_end]] = parse_ass_time(fields[i_end].strip())
+                        if e_time > s: track.append(s, e_time, fields[i_style].strip(), fields[-1].lstrip())
+                    except Exception as e: print(f"Ошибка парсинга диалога (строка {line_num}) '{line}': {e}")
+                    continue
                 if not line or line.startswith(';'): continue
                 if line.lower() == "[script info]": in_events_section = False; in_styles_section = False; style_field_names = []; continue
-                if line.lower() == "[events]": in_events_section = True; in_styles_section = False; style_field_names = []; continue
+                if line.lower() == "[events]":
+                    in_events_section = True; in_styles_section = False; style_field_names = []
+                    i_start, i_end, i_style = (event_fields.index(name) for name in ("start", "end", "style")); continue
                 if line.lower().startswith("[v4") and "styles]" in line.lower(): in_styles_section = True; in_events_section = False; style_field_names = []; continue
                 if line.startswith('[') and not (in_styles_section or in_events_section): continue
+                if in_events_section and line.lower().startswith("format:"):
+                    names = [field.strip().lower() for field in line.split(":", 1)[1].split(',')]
+                    if names and names[-1] == "text" and all(name in names for name in ("start", "end", "style")):
+                        event_fields = names; i_start, i_end, i_style = (event_fields.index(name) for name in ("start", "end", "style"))
+                    else: print(f"  Предупреждение: Нестандартный формат событий (строка {line_num}), используется стандартный: {line}")
+                    continue
                 if in_styles_section and line.lower().startswith("format:"):
-                    style_field_names = [field.strip().lower() for field in line.split(":", 1)[1].strip().split(',')]
-                    print(f"  [DEBUG STYLE PARSING] Поля стилей ({len(style_field_names)}): {style_field_names}"); continue
+                    style_field_names = [field.strip().lower() for field in line.split(":", 1)[1].strip().split(',')]; continue
                 if in_styles_section and line.lower().startswith("style:") and style_field_names:
                     try:
                         style_data_part = line.split(":", 1)[1].strip(); style_values_raw = style_data_part.split(',', len(style_field_names) - 1)
@@ -89,23 +263,15 @@ def parse_ass_file(filepath):
                                     "strikeout": style_dict_raw.get("strikeout", "0").strip() in ['-1', '1'], "borderstyle": safe_int(style_dict_raw.get("borderstyle"), 1),
                                     "outline": safe_float(style_dict_raw.get("outline"), 0), "shadow": safe_float(style_dict_raw.get("shadow"), 0),    
                                     "alignment": safe_int(style_dict_raw.get("alignment"), 2),}
-                                print(f"    [DEBUG STYLE PARSING] Стиль '{style_name}': Font='{styles[style_name]['fontname']}', Size={styles[style_name]['fontsize']}")
                             else: print(f"  Предупреждение: Несовпадение полей ({len(style_values)}) и заголовков ({len(style_field_names)}) в стиле (строка {line_num}): {line}")
                         else: print(f"  Предупреждение: Не удалось разделить строку стиля (строка {line_num}): {line}")
                     except Exception as e: print(f"  Ошибка парсинга строки стиля (строка {line_num}) '{line}': {e}")
-                elif in_events_section and line.lower().startswith("dialogue:"):
-                    match = dialogue_pattern.match(line); 
-                    if match:
-                        g = match.groups()
-                        try:
-                            s, e_time, style, text = parse_ass_time(g[1]), parse_ass_time(g[2]), g[3].strip(), g[9]
-                            if e_time > s : events.append({"start": s, "end": e_time, "duration": e_time - s, "style_name": style, "text": text})
-                        except Exception as e: print(f"Ошибка парсинга диалога (строка {line_num}) '{line}': {e}")
     except Exception as e: print(f"Критическая ошибка чтения файла '{filepath}': {e}"); traceback.print_exc()
-    events.sort(key=lambda x: x["start"])
-    if styles: print(f"Успешно загружено {len(styles)} стилей.")
+    track.finish()
+    if skipped_events: print(f"  Предупреждение: Пропущено строк Dialogue с неполными полями: {skipped_events}")
+    if styles: print(f"Успешно загружено {len(styles)} стилей, событий: {len(track)} (уникальных текстов: {len(track.texts)}).")
     else: print("Стили не загружены."); 
-    return events, styles
+    return track, styles
 
 def ass_color_to_rgb_tuple(c):
     if not isinstance(c, str) or not c.startswith('&H'): return (255,255,255) 
@@ -122,114 +288,623 @@ def get_ass_alignment(a):
     if a in [3,6,9]:tA='east'; 
     return tA, pS
 
-def create_montage_from_subs_cli(
-    available_video_files_paths, audio_filepath, subtitle_ass_file, output_filepath,
-    max_allowed_duration=0, min_allowed_duration=0
-):
-    print(f"--- Монтаж по субтитрам --- Файл: {subtitle_ass_file}, Аудио: {audio_filepath}") # Сокращенный принт
-    subtitle_events, ass_styles = parse_ass_file(subtitle_ass_file)
-    if not subtitle_events: print("Ошибка: Нет событий субтитров."); return False
+def ass_color_to_rgba_tuple(c):
+    # &HAABBGGRR: в ASS альфа 00 = непрозрачный
+    r, g, b = ass_color_to_rgb_tuple(c); a = 255
+    if isinstance(c, str) and c.startswith('&H') and len(c[2:]) == 8:
+        try: a = 255 - int(c[2:4], 16)
+        except ValueError: pass
+    return (r, g, b, a)
+
+# --- Растеризация текста субтитров (Pillow, без ImageMagick) ---
+TEXT_RENDER_CACHE_SIZE = 2048
+FONT_SEARCH_DIRS = [os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts"), os.path.expanduser("~/Library/Fonts"), "/Library/Fonts", "/System/Library/Fonts",
+                    os.path.expanduser("~/.local/share/fonts"), os.path.expanduser("~/.fonts"), "/usr/local/share/fonts", "/usr/share/fonts"]
+FONT_STYLE_SUFFIXES = {(False, False): ["", "regular"], (True, False): ["bold", "bd", "b"], (False, True): ["italic", "oblique", "i", "it"], (True, True): ["bolditalic", "boldoblique", "bi", "z"]}
+FALLBACK_FONTS = ["arial", "dejavusans", "liberationsans", "helvetica"]
+
+def _normalize_font_name(name): return re.sub(r"[^0-9a-z]", "", name.lower())
+
+@functools.lru_cache(maxsize=1)
+def _font_file_index():
+    index = {}
+    for font_dir in FONT_SEARCH_DIRS:
+        if not os.path.isdir(font_dir): continue
+        for root, _, files in os.walk(font_dir):
+            for f_name in files:
+                stem, ext = os.path.splitext(f_name)
+                if ext.lower() in ('.ttf', '.otf', '.ttc'): index.setdefault(_normalize_font_name(stem), os.path.join(root, f_name))
+    return index
+
+@functools.lru_cache(maxsize=256)
+def find_font_file(fontname, bold=False, italic=False):
+    index = _font_file_index()
+    for name in [fontname] + FALLBACK_FONTS:
+        base = _normalize_font_name(name)
+        for suffix in FONT_STYLE_SUFFIXES[(bold, italic)] + FONT_STYLE_SUFFIXES[(False, False)]:
+            if base + suffix in index: return index[base + suffix]
+    return None
+
+@functools.lru_cache(maxsize=256)
+def load_subtitle_font(fontname, fontsize, bold=False, italic=False):
+    font_path = find_font_file(fontname, bold, italic)
+    try: return ImageFont.truetype(font_path or fontname, fontsize) # Без найденного файла Pillow ищет шрифт по имени сам
+    except OSError:
+        print(f"Предупреждение: Шрифт '{fontname}' не найден, используется шрифт по умолчанию.")
+        try: return ImageFont.load_default(size=fontsize)
+        except TypeError: return ImageFont.load_default() # Pillow < 10.1
+
+def subtitle_style_key(style):
+    return (style.get("fontname", "Arial"), int(style.get("fontsize", 40)), style.get("primarycolour", "&H00FFFFFF"), style.get("outlinecolour", "&H00000000"),
+            style.get("backcolour", "&H00000000"), float(style.get("outline", 0)), float(style.get("shadow", 0)), bool(style.get("bold")), bool(style.get("italic")), int(style.get("alignment", 2)))
+
+@functools.lru_cache(maxsize=TEXT_RENDER_CACHE_SIZE)
+def render_subtitle_bitmap(text, style_key):
+    # Возвращает (rgb uint8 HxWx3, mask float HxW) - кэшируется по (текст, стиль), массивы только для чтения
+    fontname, fontsize, primary, outline_c, back, outline, shadow, bold, italic, alignment = style_key
+    font = load_subtitle_font(fontname, fontsize, bold, italic)
+    text = text.replace("\\N", "\n").replace("\\n", "\n")
+    stroke = int(round(outline)); shadow_off = int(round(shadow))
+    align, _ = get_ass_alignment(alignment); align = {'west': 'left', 'east': 'right'}.get(align, 'center')
+    x0, y0, x1, y1 = ImageDraw.Draw(Image.new("RGBA", (1, 1))).multiline_textbbox((0, 0), text, font=font, stroke_width=stroke, align=align)
+    x0, y0, x1, y1 = math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1) # Для многострочного текста bbox дробный
+    img = Image.new("RGBA", (max(1, x1 - x0 + shadow_off), max(1, y1 - y0 + shadow_off)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img); origin = (-x0, -y0)
+    if shadow_off > 0:
+        back_rgba = ass_color_to_rgba_tuple(back)
+        draw.multiline_text((origin[0] + shadow_off, origin[1] + shadow_off), text, font=font, fill=back_rgba, stroke_width=stroke, stroke_fill=back_rgba, align=align)
+    draw.multiline_text(origin, text, font=font, fill=ass_color_to_rgba_tuple(primary), stroke_width=stroke, stroke_fill=ass_color_to_rgba_tuple(outline_c), align=align)
+    rgba = np.asarray(img)
+    rgb = np.ascontiguousarray(rgba[:, :, :3]); mask = rgba[:, :, 3].astype(np.float64) / 255.0
+    rgb.setflags(write=False); mask.setflags(write=False)
+    return rgb, mask
+
+def make_subtitle_clip(text, style):
+    rgb, mask = render_subtitle_bitmap(text, subtitle_style_key(style))
+    return mp.ImageClip(rgb).set_mask(mp.ImageClip(mask, ismask=True))
+
+# --- Кэш параметров медиафайлов (probe cache) ---
+# Ключ записи: абсолютный путь; запись валидна, пока совпадают размер и mtime файла.
+PROBE_CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = ".montage_cache"
+
+def get_file_fingerprint(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+# Загруженные кэши probe держим в памяти процесса: в режиме --serve файл читается один раз, а не на каждое задание
+_RESIDENT_PROBE_CACHES = {}
+
+def load_probe_cache(cache_path):
+    key = os.path.abspath(cache_path) if cache_path else ""
+    if key in _RESIDENT_PROBE_CACHES: return _RESIDENT_PROBE_CACHES[key]
+    entries = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f: data = json.load(f)
+            if data.get("version") != PROBE_CACHE_VERSION: print(f"Кэш probe устарел (версия {data.get('version')}), будет пересоздан.")
+            else: entries = data.get("entries", {})
+        except Exception as e: print(f"Предупреждение: Не удалось прочитать кэш probe '{cache_path}': {e}")
+    _RESIDENT_PROBE_CACHES[key] = entries
+    return entries
+
+def save_probe_cache(cache_path, entries):
+    for k in [k for k in entries if not os.path.exists(k)]: del entries[k] # Удаленные файлы выбрасываем
+    if not cache_path: return
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({"version": PROBE_CACHE_VERSION, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e: print(f"Предупреждение: Не удалось сохранить кэш probe '{cache_path}': {e}")
+
+def _parse_fps(rate_str):
+    try:
+        num, _, den = str(rate_str).partition('/')
+        return float(num) / float(den) if den else float(num)
+    except (ValueError, ZeroDivisionError): return 0.0
+
+def _probe_with_ffprobe(path, kind):
+    import ffmpeg # ffmpeg-python, вызывает ffprobe
+    data = ffmpeg.probe(path)
+    fmt_duration = float(data.get("format", {}).get("duration") or 0)
+    stream = next((st for st in data.get("streams", []) if st.get("codec_type") == kind), None)
+    if stream is None: raise ValueError(f"нет потока '{kind}'")
+    duration = float(stream.get("duration") or fmt_duration or 0)
+    if kind == "audio":
+        return {"duration": duration, "sample_rate": int(stream.get("sample_rate") or 0), "channels": int(stream.get("channels") or 0), "codec": stream.get("codec_name")}
+    w, h = int(stream.get("width") or 0), int(stream.get("height") or 0)
+    rotation = stream.get("tags", {}).get("rotate") or next((sd.get("rotation") for sd in stream.get("side_data_list", []) if "rotation" in sd), 0)
+    if abs(int(float(rotation or 0))) in (90, 270): w, h = h, w # Как в FFMPEG_VideoReader
+    fps = _parse_fps(stream.get("avg_frame_rate")) or _parse_fps(stream.get("r_frame_rate"))
+    return {"duration": duration, "fps": fps, "size": [w, h], "codec": stream.get("codec_name")}
+
+def _probe_with_moviepy(path, kind):
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    infos = ffmpeg_parse_infos(path)
+    if kind == "audio":
+        if not infos.get("audio_found"): raise ValueError("нет аудиопотока")
+        return {"duration": infos.get("duration") or 0.0, "sample_rate": infos.get("audio_fps") or 0, "channels": None, "codec": None}
+    if not infos.get("video_found"): raise ValueError("нет видеопотока")
+    w, h = infos["video_size"]
+    if infos.get("video_rotation") in (90, 270): w, h = h, w
+    return {"duration": infos.get("video_duration") or infos.get("duration") or 0.0, "fps": infos.get("video_fps") or 0.0, "size": [w, h], "codec": None}
+
+def probe_media_file(path, kind):
+    try: info = _probe_with_ffprobe(path, kind)
+    except Exception: info = _probe_with_moviepy(path, kind) # Нет ffprobe/ffmpeg-python - читаем через ffmpeg -i
+    info["path"] = path
+    return info
+
+def probe_media_files(paths, kind, cache_entries=None, workers=1):
+    # Возвращает список info (None для нечитаемых файлов) в порядке paths; новые результаты дописываются в cache_entries
+    if cache_entries is None: cache_entries = {}
+    results = [None] * len(paths); to_probe = []
+    for i, p in enumerate(paths):
+        key = os.path.abspath(p)
+        try: fp = get_file_fingerprint(p)
+        except OSError as e: print(f"Предупреждение: Нет доступа к {os.path.basename(p)}: {e}"); continue
+        entry = cache_entries.get(key)
+        if entry and entry.get("kind") == kind and entry.get("size") == fp["size"] and entry.get("mtime_ns") == fp["mtime_ns"]:
+            results[i] = dict(entry["info"], path=p) if entry.get("info") else None
+        else: to_probe.append((i, p, key, fp))
+
+    def _probe_one(item):
+        i, p, key, fp = item
+        try: return item, probe_media_file(p, kind)
+        except Exception as e: print(f"Предупреждение: Не удалось загрузить {os.path.basename(p)}: {e}"); return item, None
+
+    if to_probe:
+        print(f"Probe {kind}: {len(to_probe)} новых/измененных из {len(paths)} (потоков: {max(1, workers)})")
+        if workers and workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex: probed = list(ex.map(_probe_one, to_probe))
+        else: probed = [_probe_one(item) for item in to_probe]
+        for (i, p, key, fp), info in probed:
+            results[i] = info
+            cache_entries[key] = {"kind": kind, "size": fp["size"], "mtime_ns": fp["mtime_ns"], "info": {k: v for k, v in info.items() if k != "path"} if info else None}
+    return results
+
+def build_source_video_clips_info(video_infos):
     source_video_clips_info = []
-    for p in available_video_files_paths:
+    for info in video_infos:
+        if not info: continue
+        d, f = info.get("duration"), info.get("fps")
+        if d and d > 0.1: source_video_clips_info.append({"path": info["path"], "duration": d, "fps": f if f and f > 0 else 24.0, "size": tuple(info["size"]), "codec": info.get("codec")})
+    return source_video_clips_info
+
+def target_video_profile(source_video_clips_info):
+    # (FPS, размер) монтажа - по первому исходнику; считается один раз до прокси и дальше передается явно
+    return source_video_clips_info[0]["fps"], tuple(source_video_clips_info[0]["size"])
+
+# --- Кэш прокси исходников: один раз перекодируем под целевые размер/FPS с частыми ключевыми кадрами ---
+PROXY_CACHE_VERSION = 1
+PROXY_KEYFRAME_INTERVAL = 0.5 # сек. между ключевыми кадрами - дешевый seek к случайной точке
+DEFAULT_PROXY_CACHE_MAX_GB = 20.0
+
+def proxy_cache_key(path, fingerprint, target_size, target_fps):
+    profile = (PROXY_CACHE_VERSION, os.path.abspath(path), fingerprint["size"], fingerprint["mtime_ns"], target_size[0], target_size[1], round(target_fps, 3), PROXY_KEYFRAME_INTERVAL)
+    return hashlib.sha1(repr(profile).encode('utf-8')).hexdigest()
+
+def make_source_proxy(path, proxy_path, target_size, target_fps):
+    gop = max(1, int(round(target_fps * PROXY_KEYFRAME_INTERVAL)))
+    tmp_path = f"{proxy_path}.{os.getpid()}.tmp.mp4"
+    cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", "-nostats", "-i", path, "-an",
+           "-vf", f"scale={target_size[0]}:{target_size[1]},setsar=1,fps={target_fps}",
+           "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p", "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0", tmp_path]
+    proc = subprocess.run(cmd)
+    if proc.returncode != 0:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg вернул код {proc.returncode}")
+    os.replace(tmp_path, proxy_path)
+
+def evict_cache_files(files_dir, suffix, max_bytes, keep_paths=(), label="прокси"):
+    # LRU по времени последнего использования (mtime обновляется при каждом использовании файла)
+    keep = {os.path.abspath(p) for p in keep_paths}; files = []
+    for f_name in os.listdir(files_dir):
+        p = os.path.join(files_dir, f_name)
+        if f_name.endswith(suffix) and ".tmp." not in f_name and os.path.isfile(p):
+            st = os.stat(p); files.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in files); evicted = 0
+    for _, size, p in sorted(files):
+        if total <= max_bytes: break
+        if os.path.abspath(p) in keep: continue
+        try: os.remove(p); total -= size; evicted += 1
+        except OSError: pass
+    if evicted: print(f"Кэш {label}: удалено {evicted} старых файлов, занято {total / 1024**3:.2f} ГБ")
+    if total > max_bytes: print(f"Предупреждение: Файлы {label} текущего запуска ({total / 1024**3:.2f} ГБ) не помещаются в лимит кэша {max_bytes / 1024**3:.2f} ГБ.")
+
+def prepare_source_proxies(source_video_clips_info, cache_dir, probe_cache=None, workers=1, max_bytes=DEFAULT_PROXY_CACHE_MAX_GB * 1024**3, target=None):
+    if not source_video_clips_info: return source_video_clips_info
+    target_fps, target_size = target or target_video_profile(source_video_clips_info)
+    proxy_dir = os.path.join(cache_dir or tempfile.gettempdir(), "proxies"); os.makedirs(proxy_dir, exist_ok=True)
+    items = []; to_make = []
+    for info in source_video_clips_info:
+        try: proxy_path = os.path.join(proxy_dir, proxy_cache_key(info["path"], get_file_fingerprint(info["path"]), target_size, target_fps) + ".mp4")
+        except OSError as e: print(f"Предупреждение: Нет доступа к {os.path.basename(info['path'])}: {e}"); continue
+        items.append((info, proxy_path))
+        if not os.path.exists(proxy_path): to_make.append((info, proxy_path))
+
+    def _make_one(item):
+        info, proxy_path = item
+        try: make_source_proxy(info["path"], proxy_path, target_size, target_fps); return True
+        except Exception as e: print(f"Предупреждение: Не удалось создать прокси для {os.path.basename(info['path'])}: {e}"); return False
+
+    if to_make:
+        print(f"Прокси: перекодирование {len(to_make)} из {len(items)} исходников в {target_size[0]}x{target_size[1]}@{target_fps} (потоков: {max(1, workers)})")
+        if workers and workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex: list(ex.map(_make_one, to_make))
+        else:
+            for item in to_make: _make_one(item)
+    ready = [proxy_path for _, proxy_path in items if os.path.exists(proxy_path)]
+    proxy_infos = dict(zip(ready, probe_media_files(ready, "video", probe_cache)))
+    result = []; used = []
+    for info, proxy_path in items: # Порядок исходников сохраняется: от него зависит выбор фрагментов при том же --seed
+        proxy_info = proxy_infos.get(proxy_path)
+        if not proxy_info: result.append(info); continue # Без прокси - читаем оригинал
+        os.utime(proxy_path, None); used.append(proxy_path)
+        result.append(dict(info, proxy_path=proxy_path, duration=min(info["duration"], proxy_info["duration"] or info["duration"])))
+    evict_cache_files(proxy_dir, ".mp4", max_bytes, keep_paths=used)
+    print(f"Прокси готовы: {len(used)} из {len(source_video_clips_info)}")
+    return result
+
+# --- Фоновая музыка: декодируется один раз в float32 PCM (<cache_dir>/audio), дальше читается через np.memmap ---
+# Файл открывается только на чтение, поэтому параллельные воркеры делят одни и те же страницы page cache
+AUDIO_CACHE_VERSION = 1
+AUDIO_SAMPLE_RATE = 44100 # Как у write_videofile по умолчанию
+AUDIO_CHANNELS = 2
+DEFAULT_AUDIO_CACHE_MAX_GB = 2.0 # ~21 МБ на минуту музыки; без --cache_dir файлы лежат во временной папке системы и ограничены тем же лимитом
+OPEN_AUDIO_MAPS_SIZE = 8 # Сервис живет долго: держим открытыми только недавно игравшие треки
+_OPEN_AUDIO_MAPS = collections.OrderedDict()
+
+def audio_pcm_path(path, cache_dir, sample_rate=AUDIO_SAMPLE_RATE):
+    fp = get_file_fingerprint(path)
+    key = hashlib.sha1(repr((AUDIO_CACHE_VERSION, os.path.abspath(path), fp["size"], fp["mtime_ns"], AUDIO_CHANNELS)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir or tempfile.gettempdir(), "audio", f"{key}_{sample_rate}.f32")
+
+def ensure_audio_pcm(path, cache_dir, sample_rate=AUDIO_SAMPLE_RATE, max_bytes=DEFAULT_AUDIO_CACHE_MAX_GB * 1024**3):
+    pcm_path = audio_pcm_path(path, cache_dir, sample_rate)
+    if os.path.exists(pcm_path): os.utime(pcm_path, None); return pcm_path
+    os.makedirs(os.path.dirname(pcm_path), exist_ok=True)
+    tmp_path = f"{pcm_path}.{os.getpid()}.tmp"
+    cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", "-nostats", "-i", path, "-vn",
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(AUDIO_CHANNELS), "-ar", str(sample_rate), tmp_path]
+    proc = subprocess.run(cmd)
+    if proc.returncode != 0 or not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise RuntimeError(f"Не удалось декодировать аудио '{path}' (код ffmpeg {proc.returncode})")
+    os.replace(tmp_path, pcm_path) # Воркеры, декодировавшие один файл одновременно, просто перезапишут одинаковый результат
+    evict_cache_files(os.path.dirname(pcm_path), ".f32", max_bytes, keep_paths=[pcm_path] + list(_OPEN_AUDIO_MAPS), label="аудио")
+    return pcm_path
+
+def open_audio_pcm(pcm_path):
+    # Вытесненное отображение закрывается, когда его отпустит последний клип (np.memmap держит mmap, пока жив массив)
+    if pcm_path in _OPEN_AUDIO_MAPS: _OPEN_AUDIO_MAPS.move_to_end(pcm_path)
+    else: _OPEN_AUDIO_MAPS[pcm_path] = np.memmap(pcm_path, dtype=np.float32, mode='r').reshape(-1, AUDIO_CHANNELS)
+    while len(_OPEN_AUDIO_MAPS) > OPEN_AUDIO_MAPS_SIZE: _OPEN_AUDIO_MAPS.popitem(last=False)
+    return _OPEN_AUDIO_MAPS[pcm_path]
+
+def prepare_audio_cache(audio_paths, cache_dir, workers=1):
+    # Декодируем заранее (при планировании), чтобы воркеры рендера только открывали готовые файлы
+    audio_paths = sorted(set(audio_paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for fut in [pool.submit(ensure_audio_pcm, p, cache_dir) for p in audio_paths]:
+            try: fut.result()
+            except Exception as e: print(f"Предупреждение: {e}")
+
+def audio_gain(t, duration, fade):
+    # Линейное нарастание в начале и затухание в конце монтажа
+    return np.clip(np.minimum(t, duration - t) / fade, 0.0, 1.0)
+
+def make_pcm_audio_clip(pcm, duration, fade=0.0, sample_rate=AUDIO_SAMPLE_RATE):
+    # Зацикливание и обрезка - арифметика индексов по отображенному буферу: кусок без перехода через конец трека - срез без копирования
+    n = len(pcm); fade = min(fade, duration / 2.0)
+    def make_frame(t):
+        idx = np.rint(np.asarray(t, dtype=np.float64) * sample_rate).astype(np.int64)
+        if idx.ndim == 0 or len(idx) == 0: frames = pcm[idx % n]
+        else:
+            i0 = int(idx[0]) % n
+            if int(idx[-1]) - int(idx[0]) == len(idx) - 1 and i0 + len(idx) <= n: frames = pcm[i0:i0 + len(idx)]
+            else: frames = pcm[idx % n]
+        if fade > 0:
+            gain = audio_gain(np.asarray(t, dtype=np.float64), duration, fade)
+            if np.any(gain < 1.0): frames = frames * gain[..., None].astype(np.float32)
+        return frames
+    return load_moviepy().AudioClip(make_frame, duration=duration, fps=sample_rate)
+
+def ffmpeg_pcm_input_args(pcm_path, sample_rate=AUDIO_SAMPLE_RATE):
+    return ["-f", "f32le", "-ar", str(sample_rate), "-ac", str(AUDIO_CHANNELS), "-stream_loop", "-1", "-i", pcm_path]
+
+def ffmpeg_audio_fade_filter(duration, fade):
+    fade = min(fade, duration / 2.0)
+    return f",afade=t=in:st=0:d={fade:.6f},afade=t=out:st={duration - fade:.6f}:d={fade:.6f}" if fade > 0 else ""
+
+# --- Кэш разобранных субтитров в памяти процесса (для пакетов и воркеров) ---
+# Разобранные дорожки по хэшу содержимого: в памяти процесса (ограниченно - сервис живет долго) и в <cache_dir>/subs
+SUBTITLE_CACHE_VERSION = 1
+_PARSED_SUBTITLES_CACHE = collections.OrderedDict()
+PARSED_SUBTITLES_CACHE_SIZE = 64
+_SUBTITLE_FILE_HASHES = {}
+
+def subtitle_file_hash(filepath):
+    # Хэш считается один раз на версию файла (путь, размер, mtime)
+    fp = get_file_fingerprint(filepath); key = (os.path.abspath(filepath), fp["size"], fp["mtime_ns"])
+    if key not in _SUBTITLE_FILE_HASHES:
+        if len(_SUBTITLE_FILE_HASHES) > 16 * PARSED_SUBTITLES_CACHE_SIZE: _SUBTITLE_FILE_HASHES.clear()
+        h = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+        _SUBTITLE_FILE_HASHES[key] = h.hexdigest()
+    return _SUBTITLE_FILE_HASHES[key]
+
+def _load_parsed_subtitles(cache_path):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f: data = json.load(f)
+        if data.get("version") != SUBTITLE_CACHE_VERSION: return None
+        return SubtitleTrack.from_dict(data["track"]), data["styles"]
+    except Exception as e: print(f"Предупреждение: Не удалось прочитать кэш субтитров '{cache_path}': {e}"); return None
+
+def _save_parsed_subtitles(cache_path, track, styles):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({"version": SUBTITLE_CACHE_VERSION, "styles": styles, "track": track.to_dict()}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e: print(f"Предупреждение: Не удалось сохранить кэш субтитров '{cache_path}': {e}")
+
+def load_subtitles_cached(filepath, cache_dir=""):
+    try: key = subtitle_file_hash(filepath)
+    except OSError: return parse_ass_file(filepath)
+    if key in _PARSED_SUBTITLES_CACHE: _PARSED_SUBTITLES_CACHE.move_to_end(key); return _PARSED_SUBTITLES_CACHE[key]
+    cache_path = os.path.join(cache_dir, "subs", f"{key}.json") if cache_dir else ""
+    parsed = _load_parsed_subtitles(cache_path) if cache_path and os.path.exists(cache_path) else None
+    if parsed: print(f"Субтитры из кэша: {filepath} (событий: {len(parsed[0])})")
+    else:
+        parsed = parse_ass_file(filepath)
+        if cache_path and len(parsed[0]): _save_parsed_subtitles(cache_path, *parsed)
+    _PARSED_SUBTITLES_CACHE[key] = parsed
+    while len(_PARSED_SUBTITLES_CACHE) > PARSED_SUBTITLES_CACHE_SIZE: _PARSED_SUBTITLES_CACHE.popitem(last=False)
+    return parsed
+
+# --- План монтажа: какие фрагменты и тексты в какое время ---
+def build_montage_plan(subtitle_events, ass_styles, source_video_clips_info, max_allowed_duration=0, rng=None, target=None):
+    rng = rng or random.Random()
+    target_fps, target_size = target or target_video_profile(source_video_clips_info)
+    plan = {"fps": target_fps, "size": [target_size[0], target_size[1]], "duration": 0.0, "segments": [], "texts": [], "events_used": 0}
+    montage_time = 0.0
+    # События упорядочены по началу: окно max_allowed_duration находится bisect, остальная дорожка не просматривается
+    n_used = subtitle_events.count_before(max_allowed_duration) if max_allowed_duration else len(subtitle_events)
+    if n_used < len(subtitle_events): print(f"Макс.длит {max_allowed_duration}s")
+    plan["events_used"] = n_used
+    starts, ends = subtitle_events.starts, subtitle_events.ends
+    for idx in range(n_used):
+        seg_start = starts[idx]; seg_dur = ends[idx] - seg_start
+        if max_allowed_duration and seg_start + seg_dur > max_allowed_duration: seg_dur = max_allowed_duration - seg_start
+        if seg_dur <= 0.02: continue
+
+        vid_info = rng.choice(source_video_clips_info); max_s = vid_info["duration"] - seg_dur
+        # Источник короче сегмента - берем его целиком (последний кадр держится до конца сегмента)
+        seg_in = rng.uniform(0, max_s) if max_s >= 0 else 0.0
+        plan["segments"].append({"path": vid_info.get("proxy_path") or vid_info["path"], "source": vid_info["path"], "in": seg_in, "duration": seg_dur, "start": seg_start, "source_duration": vid_info["duration"],
+                                 "source_fps": target_fps if vid_info.get("proxy_path") else vid_info["fps"]}) # FPS читаемого файла (прокси - уже в целевом FPS)
+
+        style_name = subtitle_events.style_names[subtitle_events.style_ids[idx]]; style = ass_styles.get(style_name, ass_styles.get("Default",{}))
+        if not style and style_name!="Default": style=ass_styles.get("Default",{})
+        if not style: print(f"Предупреждение: Стили '{style_name}' и 'Default' не найдены.")
+        txt = subtitle_events.plain_text(idx)
+        if txt.strip(): plan["texts"].append({"text": txt, "style": style, "start": seg_start, "duration": seg_dur})
+        elif subtitle_events.texts[subtitle_events.text_ids[idx]].strip(): print(f"Текст @ {seg_start:.2f}s был из тегов. Пропуск.")
+        montage_time = max(montage_time, seg_start + seg_dur)
+    plan["duration"] = montage_time
+    return plan
+
+def make_text_clip(txt, style, text_renderer="pillow"):
+    if text_renderer == "pillow": return make_subtitle_clip(txt, style)
+    font = style.get("fontname","Arial"); size_f = int(style.get("fontsize",40)); color_t = ass_color_to_rgb_tuple(style.get("primarycolour","&H00FFFFFF"))
+    print(f"  TextClip: '{txt[:20]}...', Font='{font}', Size={size_f}, Color={color_t}")
+    current_imagemagick_binary = check_imagemagick()
+    if not current_imagemagick_binary or not os.path.exists(current_imagemagick_binary):
+        print("ОШИБКА: Путь к ImageMagick недействителен или не найден. TextClip не будет создан.")
+        raise FileNotFoundError(f"ImageMagick не найден или путь невалиден: {current_imagemagick_binary}")
+
+    print(f"  [DEBUG TextClip] Используется ImageMagick: {current_imagemagick_binary}")
+    tc_inst = mp.TextClip(txt=txt, 
+                          font=font, 
+                          fontsize=size_f, 
+                          color=color_t,
+                          imagemagick_binary=current_imagemagick_binary
+                          )
+    print(f"    TextClip создан успешно.")
+    return tc_inst
+
+def default_encoder_threads(): return max(1,os.cpu_count()//2 if os.cpu_count() else 2)
+
+DEFAULT_X264_PRESET = 'ultrafast'
+
+# --- Пул видеоридеров с LRU и фоновым декодированием сегментов (бэкенд MoviePy) ---
+DEFAULT_MAX_OPEN_READERS = 8
+DEFAULT_PREFETCH_THREADS = 2
+DEFAULT_PREFETCH_FRAMES = 16
+
+class VideoReaderPool:
+    # Не больше max_open процессов ffmpeg одновременно; вытесненный ридер прозрачно открывается заново при следующем запросе кадра.
+    # На один исходник может быть открыто несколько ридеров: запрос идет к ридеру, который дочитает до нужного кадра без перезапуска ffmpeg,
+    # поэтому соседние сегменты из одного файла (предзагрузка и текущий кадр) не сбивают друг другу позицию чтения.
+    READ_AHEAD_FRAMES = 100 # Как в FFMPEG_VideoReader.get_frame: дальше этого ридер перезапускает ffmpeg с seek
+
+    def __init__(self, target_size, max_open=DEFAULT_MAX_OPEN_READERS):
+        self.target_size = tuple(target_size); self.max_open = max(1, max_open)
+        self.readers = collections.OrderedDict(); self.busy = set(); self.lock = threading.Lock(); self.opened_total = 0; self._next_id = 0
+
+    def _open_reader(self, path):
+        from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+        return FFMPEG_VideoReader(path, target_resolution=(self.target_size[1], self.target_size[0]), fps_source="fps")
+
+    def _read_cost(self, reader, t):
+        # 0 - тот же кадр, n - прочитать n кадров вперед, None - ридеру придется перезапускать ffmpeg
+        pos = int(reader.fps * t + 0.00001) + 1; cur = getattr(reader, "pos", None)
+        if cur is None or not cur <= pos <= cur + self.READ_AHEAD_FRAMES: return None
+        return pos - cur
+
+    def _evict_locked(self, keep=None):
+        for reader_id in list(self.readers):
+            if len(self.readers) < self.max_open: return
+            if reader_id in self.busy or reader_id == keep: continue # Ридер сейчас читает (или пойдет в дело) - пропускаем
+            try: self.readers.pop(reader_id)[1].close()
+            except Exception: pass
+
+    def _acquire_locked(self, path, t):
+        idle = [(reader_id, reader) for reader_id, (r_path, reader) in self.readers.items() if r_path == path and reader_id not in self.busy]
+        costs = [(cost, reader_id) for cost, reader_id in ((self._read_cost(reader, t), reader_id) for reader_id, reader in idle) if cost is not None]
+        if costs: reader_id = min(costs)[1]
+        else:
+            reuse_id = idle[-1][0] if idle else None # Последний использованный ридер этого файла не вытесняем: если лимит занят, он сделает seek
+            self._evict_locked(keep=reuse_id)
+            if len(self.readers) >= self.max_open and reuse_id is not None: reader_id = reuse_id
+            else: reader_id = self._next_id; self._next_id += 1; self.readers[reader_id] = (path, None)
+        self.busy.add(reader_id); self.readers.move_to_end(reader_id)
+        return reader_id, self.readers[reader_id][1]
+
+    def get_frame(self, path, t):
+        with self.lock: reader_id, reader = self._acquire_locked(path, t)
         try:
-            with mp.VideoFileClip(p) as tc: d,f,s = tc.duration,tc.fps,tc.size
-            if d and d > 0.1: source_video_clips_info.append({"path":p,"duration":d,"fps":f if f and f>0 else 24.0,"size":s})
-        except: print(f"Предупреждение: Не удалось загрузить {os.path.basename(p)}.");
-    if not source_video_clips_info: print("Ошибка: Нет видео для монтажа."); return False
-    
-    main_audio_clip = None; opened_clips = {}; vid_segs = []; txt_segs = []
+            if reader is None:
+                reader = self._open_reader(path)
+                with self.lock: self.readers[reader_id] = (path, reader); self.opened_total += 1
+            frame = reader.get_frame(t)
+        except Exception:
+            with self.lock:
+                if self.readers.get(reader_id, (None, None))[1] is None: self.readers.pop(reader_id, None)
+            raise
+        finally:
+            with self.lock: self.busy.discard(reader_id)
+        if frame.shape[1] != self.target_size[0] or frame.shape[0] != self.target_size[1]:
+            frame = np.asarray(Image.fromarray(frame).resize(self.target_size))
+        return frame
+
+    def close(self):
+        with self.lock:
+            for _, reader in self.readers.values():
+                try:
+                    if reader is not None: reader.close()
+                except Exception: pass
+            self.readers.clear()
+
+class SegmentFramePrefetcher:
+    # Фоновые потоки берут сегменты из общей очереди в порядке начала и декодируют их кадры заранее в ограниченные очереди,
+    # пока композитор и кодировщик работают с текущими кадрами. В памяти не больше threads * queue_size кадров.
+    # Сегмент, который сейчас не декодирует ни один поток (потоки заняты более ранними, еще идущими на экране), читается синхронно.
+    def __init__(self, pool, segments, fps, n_threads=DEFAULT_PREFETCH_THREADS, queue_size=DEFAULT_PREFETCH_FRAMES):
+        self.pool, self.segments, self.fps = pool, segments, fps
+        self.frame_ranges = [(math.ceil(seg["start"] * fps - 1e-6), math.ceil((seg["start"] + seg["duration"]) * fps - 1e-6)) for seg in segments]
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in segments]
+        self.claimed = [False] * len(segments); self.done = [False] * len(segments); self.held = [None] * len(segments); self.current_frame = 0; self.stopped = False
+        self.pending = collections.deque(sorted(range(len(segments)), key=lambda i: segments[i]["start"])); self.claim_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._produce, daemon=True) for _ in range(max(1, n_threads))]
+        for th in self.threads: th.start()
+
+    def source_time(self, seg_idx, t):
+        seg = self.segments[seg_idx]
+        return min(seg["in"] + t, max(0.0, seg["source_duration"] - 1.0 / self.fps)) # За концом исходника держим последний кадр
+
+    def _claim_next(self):
+        with self.claim_lock:
+            while self.pending and not self.stopped:
+                i = self.pending.popleft()
+                if self.frame_ranges[i][1] > self.current_frame: self.claimed[i] = True; return i # Уже пройденные сегменты пропускаем
+                self.done[i] = True
+            return None
+
+    def _produce(self):
+        while True:
+            i = self._claim_next()
+            if i is None: return
+            seg = self.segments[i]; n0, n1 = self.frame_ranges[i]
+            try:
+                for n in range(max(n0, self.current_frame), n1):
+                    if self.stopped or n1 <= self.current_frame: break # Композитор уже прошел этот сегмент
+                    frame = self.pool.get_frame(seg["path"], self.source_time(i, n / self.fps - seg["start"]))
+                    while not self.stopped and n1 > self.current_frame:
+                        try: self.queues[i].put((n, frame), timeout=0.1); break
+                        except queue.Full: continue
+            except Exception as e: print(f"Предупреждение: Предзагрузка сегмента из {os.path.basename(seg['path'])} прервана: {e}"); traceback.print_exc()
+            finally: self.done[i] = True # Дальше кадры этого сегмента декодируются синхронно
+
+    def get_frame(self, seg_idx, t):
+        seg = self.segments[seg_idx]; n = int(round((t + seg["start"]) * self.fps))
+        self.current_frame = max(self.current_frame, n)
+        n0, n1 = self.frame_ranges[seg_idx]; q = self.queues[seg_idx]
+        while n0 <= n < n1:
+            if self.held[seg_idx] is not None: item_n, frame = self.held[seg_idx]; self.held[seg_idx] = None
+            else:
+                try: item_n, frame = q.get(timeout=0.05)
+                except queue.Empty:
+                    if not self.claimed[seg_idx] or self.done[seg_idx] or self.stopped: break # Ждать некого
+                    continue
+            if item_n == n: return frame
+            if item_n > n: self.held[seg_idx] = (item_n, frame); break # Запрос кадра не по порядку - декодируем синхронно, очередь не трогаем
+        return self.pool.get_frame(seg["path"], self.source_time(seg_idx, t))
+
+    def stop(self):
+        self.stopped = True
+        for th in self.threads: th.join(timeout=5.0)
+
+# --- Бэкенд MoviePy (эталонный): покадровая композиция в Python ---
+def render_plan_moviepy(plan, audio_filepath, output_filepath, text_renderer="pillow", threads=None, show_progress=True, preset=DEFAULT_X264_PRESET,
+                        max_open_readers=DEFAULT_MAX_OPEN_READERS, prefetch_threads=DEFAULT_PREFETCH_THREADS, prefetch_frames=DEFAULT_PREFETCH_FRAMES,
+                        cache_dir=DEFAULT_CACHE_DIR, audio_fade=0.0):
+    target_fps, target_size, montage_time = plan["fps"], tuple(plan["size"]), plan["duration"]
+    main_audio_clip = None; reader_pool = None; prefetcher = None; vid_segs = []; txt_segs = []
     base_vid_comp = None; vid_w_audio = None; final_comp = None
+    load_moviepy()
     try:
-        main_audio_clip = mp.AudioFileClip(audio_filepath)
-        target_fps, target_size = source_video_clips_info[0]["fps"], source_video_clips_info[0]["size"]
-        print(f"Цель: FPS={target_fps}, Размер={target_size}")
-        montage_time = 0.0
-        for idx, sub_e in enumerate(subtitle_events):
-            seg_dur, seg_start = sub_e["duration"], sub_e["start"]
-            if max_allowed_duration and seg_start >= max_allowed_duration: print(f"Макс.длит {max_allowed_duration}s"); break
-            if max_allowed_duration and seg_start + seg_dur > max_allowed_duration: seg_dur = max_allowed_duration - seg_start
-            if seg_dur <= 0.02: continue
-            
-            vid_info = random.choice(source_video_clips_info); vid_path = vid_info["path"]
-            try:
-                if vid_path not in opened_clips:
-                    cl = mp.VideoFileClip(vid_path, target_resolution=(target_size[1],target_size[0]), fps_source="fps")
-                    if not cl.fps or cl.fps<=0: cl.fps=target_fps
-                    if cl.size[0]!=target_size[0] or cl.size[1]!=target_size[1]: cl=cl.resize(width=target_size[0],height=target_size[1])
-                    opened_clips[vid_path]=cl
-                src_cl = opened_clips[vid_path]
-                max_s = vid_info["duration"] - seg_dur
-                v_seg = src_cl.subclip(0,vid_info["duration"]).set_duration(seg_dur) if max_s<0 and vid_info["duration"]>=0.1 else (src_cl.subclip(random.uniform(0,max_s),random.uniform(0,max_s)+seg_dur) if max_s>=0 else None)
-                if not v_seg: continue
-                if not v_seg.fps: v_seg.fps=target_fps
-                vid_segs.append(v_seg.set_start(seg_start).set_duration(seg_dur))
-            except Exception as e: print(f"Ошибка видео-сегмента из {os.path.basename(vid_path)}: {e}")
-            
-            try: # ТЕКСТОВЫЙ КЛИП
-                style_name = sub_e["style_name"]; style = ass_styles.get(style_name, ass_styles.get("Default",{}))
-                if not style and style_name!="Default": style=ass_styles.get("Default",{})
-                if not style: print(f"Предупреждение: Стили '{style_name}' и 'Default' не найдены.")
-                
-                font = style.get("fontname","Arial"); size_f = int(style.get("fontsize",40)); color_t = ass_color_to_rgb_tuple(style.get("primarycolour","&H00FFFFFF"))
-                
-                txt = re.sub(r"\{[^}]*\}","",sub_e["text"])
-                if not txt.strip(): 
-                    if sub_e["text"].strip(): print(f"Текст @ {seg_start:.2f}s был из тегов. Пропуск.")
-                    montage_time = max(montage_time, seg_start + seg_dur); continue
-                
-                print(f"  TextClip: '{txt[:20]}...', Font='{font}', Size={size_f}, Color={color_t}")
-                tc_inst = None
+        with profile_stage("open_audio"):
+            if audio_filepath: main_audio_clip = make_pcm_audio_clip(open_audio_pcm(ensure_audio_pcm(audio_filepath, cache_dir)), montage_time, audio_fade)
+        print(f"Цель: FPS={target_fps}, Размер={target_size}, ридеров ffmpeg не более {max_open_readers}, потоков предзагрузки {prefetch_threads}")
+        with profile_stage("build_segments"):
+            reader_pool = VideoReaderPool(target_size, max_open_readers)
+            segments = plan["segments"]
+            if prefetch_threads > 0: prefetcher = SegmentFramePrefetcher(reader_pool, segments, target_fps, prefetch_threads, prefetch_frames)
+            for seg_idx, seg in enumerate(segments):
+                if prefetcher: make_frame = functools.partial(prefetcher.get_frame, seg_idx)
+                else: make_frame = lambda t, seg=seg: reader_pool.get_frame(seg["path"], min(seg["in"] + t, max(0.0, seg["source_duration"] - 1.0 / target_fps)))
+                v_seg = mp.VideoClip(duration=seg["duration"]) # Без make_frame в конструкторе: иначе VideoClip декодирует кадр ради размера
+                v_seg.make_frame = make_frame; v_seg.size = target_size; v_seg.fps = target_fps
+                vid_segs.append(v_seg.set_start(seg["start"]))
+
+        with profile_stage("text_clips"):
+            for txt_e in plan["texts"]: # ТЕКСТОВЫЕ КЛИПЫ
                 try:
-                    current_imagemagick_binary = IMAGEMAGICK_DEFAULT_BINARY_PATH
-                    if not current_imagemagick_binary or not os.path.exists(current_imagemagick_binary):
-                        print("ОШИБКА: Путь к ImageMagick недействителен или не найден. TextClip не будет создан.")
-                        raise FileNotFoundError(f"ImageMagick не найден или путь невалиден: {current_imagemagick_binary}")
-
-                    print(f"  [DEBUG TextClip] Используется ImageMagick: {current_imagemagick_binary}")
-                    tc_inst = mp.TextClip(txt=txt, 
-                                          font=font, 
-                                          fontsize=size_f, 
-                                          color=color_t,
-                                          imagemagick_binary=current_imagemagick_binary
-                                          )
-                    print(f"    TextClip создан успешно.")
-                except Exception as e_tc: 
-                    print(f"    Ошибка TextClip: {e_tc}")
+                    tc_inst = make_text_clip(txt_e["text"], txt_e["style"], text_renderer)
+                    _,txt_pos_default = get_ass_alignment(txt_e["style"].get("alignment", 2))
+                    txt_segs.append(tc_inst.set_duration(txt_e["duration"]).set_start(txt_e["start"]).set_position(txt_pos_default))
+                except Exception as e_tc:
+                    print(f"    Ошибка текстового клипа: {e_tc}")
                     traceback.print_exc() # Печатаем полный трейсбек ошибки TextClip
-                    montage_time = max(montage_time, seg_start + seg_dur); continue 
-                
-                if tc_inst:
-                    _,txt_pos_default = get_ass_alignment(style.get("alignment", 2))
-                    tc_inst=tc_inst.set_duration(seg_dur).set_start(seg_start).set_position(txt_pos_default)
-                    txt_segs.append(tc_inst)
-            except Exception as e: print(f"Ошибка блока текста: {e}"); traceback.print_exc()
-            montage_time = max(montage_time, seg_start + seg_dur)
-
-        if min_allowed_duration and montage_time < min_allowed_duration: print(f"Ошибка: Длит. ({montage_time:.2f}s) < мин. ({min_allowed_duration}s)."); return False
-        if not vid_segs: print("Ошибка: Нет видео-сегментов."); return False
-        print(f"Событий: {idx+1 if subtitle_events else 0}. Длит. монтажа: {montage_time:.2f}s")
 
         valid_vs = [vs for vs in vid_segs if vs and vs.duration and vs.duration>0]
         if not valid_vs: print("Ошибка: Нет валидных видеосегментов."); return False
-        base_vid_comp = mp.CompositeVideoClip(valid_vs,size=target_size,bg_color=(0,0,0)).set_duration(montage_time)
-        if not base_vid_comp.fps: base_vid_comp.fps=target_fps
-        
-        audio_final = main_audio_clip.subclip(0,montage_time)
-        if montage_time > main_audio_clip.duration:
-            audio_final = mp.concatenate_audioclips([main_audio_clip]*(int(montage_time/main_audio_clip.duration)+1)).subclip(0,montage_time)
-        vid_w_audio = base_vid_comp.set_audio(audio_final)
-
-        final_render_clips = [vid_w_audio] + txt_segs
-        final_comp = mp.CompositeVideoClip(final_render_clips,size=target_size,bg_color=(0,0,0)).set_duration(montage_time)
-        if not final_comp.fps: final_comp.fps=target_fps
+        with profile_stage("composite_setup"):
+            base_vid_comp = mp.CompositeVideoClip(valid_vs,size=target_size,bg_color=(0,0,0)).set_duration(montage_time)
+            if not base_vid_comp.fps: base_vid_comp.fps=target_fps
+
+            vid_w_audio = base_vid_comp
+            if main_audio_clip: vid_w_audio = base_vid_comp.set_audio(main_audio_clip) # Без аудио рендерятся куски для склейки (звук добавляется один раз в конце)
+
+            final_render_clips = [vid_w_audio] + txt_segs
+            final_comp = mp.CompositeVideoClip(final_render_clips,size=target_size,bg_color=(0,0,0)).set_duration(montage_time)
+            if not final_comp.fps: final_comp.fps=target_fps
 
         print(f"Сохранение: {output_filepath}, FPS: {final_comp.fps or target_fps}")
-        final_comp.write_videofile(output_filepath,codec='libx264',fps=(final_comp.fps or target_fps),threads=max(1,os.cpu_count()//2 if os.cpu_count() else 2),preset='ultrafast',audio_codec='aac',audio_bitrate='192k',logger='bar')
-        print(f"Сохранено: {output_filepath}"); return True
+        with profile_stage("encode"): # Композиция в MoviePy ленивая: декодирование и наложение кадров идут внутри write_videofile
+            final_comp.write_videofile(output_filepath,codec='libx264',fps=(final_comp.fps or target_fps),threads=threads or default_encoder_threads(),preset=preset,audio=bool(main_audio_clip),audio_codec='aac',audio_bitrate='192k',logger='bar' if show_progress else None)
+        return True
     except Exception as e: print(f"Крит. ошибка монтажа: {e}"); traceback.print_exc(); return False
     finally:
         print("Освобождение ресурсов...")
-        res_list=[main_audio_clip,base_vid_comp,vid_w_audio,final_comp]+list(opened_clips.values())+vid_segs+txt_segs
+        if prefetcher: prefetcher.stop()
+        if reader_pool: reader_pool.close(); print(f"Открытий ридеров ffmpeg: {reader_pool.opened_total}")
+        res_list=[main_audio_clip,base_vid_comp,vid_w_audio,final_comp]+vid_segs+txt_segs
         for cl_obj in res_list:
             if cl_obj and hasattr(cl_obj,'close'):
                 try:
@@ -238,33 +913,425 @@ def create_montage_from_subs_cli(
                 except:pass
         print("Ресурсы освобождены.")
 
+# --- Бэкенд ffmpeg: весь монтаж одним filtergraph (декодирование, масштаб, наложение и кодирование в ffmpeg) ---
+@functools.lru_cache(maxsize=None)
+def get_ffmpeg_binary():
+    # Как в moviepy.config, но без его импорта: он при импорте запускает ffmpeg -version и convert в каждом процессе
+    binary = os.getenv("FFMPEG_BINARY", "ffmpeg-imageio")
+    if binary != "ffmpeg-imageio": return binary
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception: return "ffmpeg"
+
+def flatten_video_segments(segments, duration):
+    # Как CompositeVideoClip: в каждый момент виден последний по списку активный сегмент, в дырах - черный кадр.
+    # Возвращает непересекающиеся куски [(индекс сегмента или None, начало, конец)] на отрезке [0, duration)
+    bounds = sorted({0.0, duration} | {min(duration, max(0.0, t)) for seg in segments for t in (seg["start"], seg["start"] + seg["duration"])})
+    order = sorted(range(len(segments)), key=lambda i: segments[i]["start"]); pos = 0; active = []; pieces = []
+    for a, b in zip(bounds, bounds[1:]):
+        if b <= a: continue
+        while pos < len(order) and segments[order[pos]]["start"] <= a:
+            i = order[pos]; heapq.heappush(active, (-i, segments[i]["start"] + segments[i]["duration"])); pos += 1
+        while active and active[0][1] <= a: heapq.heappop(active)
+        top = -active[0][0] if active else None
+        if pieces and pieces[-1][0] == top and pieces[-1][2] == a: pieces[-1] = (top, pieces[-1][1], b)
+        else: pieces.append((top, a, b))
+    return pieces
+
+def subtitle_png_path(text, style, png_dir):
+    style_key = subtitle_style_key(style)
+    name = hashlib.sha1(repr((text, style_key)).encode('utf-8')).hexdigest() + ".png"
+    path = os.path.join(png_dir, name)
+    if not os.path.exists(path):
+        rgb, mask = render_subtitle_bitmap(text, style_key)
+        tmp_path = f"{path}.{os.getpid()}.tmp.png"
+        Image.fromarray(np.dstack([rgb, np.round(mask * 255).astype(np.uint8)]), "RGBA").save(tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+def subtitle_overlay_xy(style, img_size, frame_size):
+    # Та же позиция, что дает set_position(get_ass_alignment(...)) в MoviePy
+    _, (pos_x, pos_y) = get_ass_alignment(style.get("alignment", 2))
+    (w, h), (W, H) = img_size, frame_size
+    x = {'left': 0, 'center': (W - w) // 2, 'right': W - w}[pos_x]
+    y = {'top': 0, 'center': (H - h) // 2, 'bottom': H - h}[pos_y]
+    return x, y
+
+FFMPEG_MANY_INPUTS = 500 # Выше этого - предупреждение: каждый кусок видео - отдельный -i со своим декодером, все открыты одновременно
+
+def build_ffmpeg_filtergraph(plan, png_dir):
+    # Возвращает (входы - список списков аргументов, текст filtergraph, метка выхода видео). Время режется по сетке кадров:
+    # кадр n (t=n/fps) берется из куска, содержащего t, как при покадровом рендере MoviePy.
+    # Один вход на исходник через split не годится: concat потребляет куски по очереди, и split копил бы в памяти все кадры до нужного куска.
+    fps, (W, H), duration = plan["fps"], plan["size"], plan["duration"]
+    segments = plan["segments"]; inputs = []; chains = []; labels = []
+    for k, (seg_idx, a, b) in enumerate(flatten_video_segments(segments, duration)):
+        n0, n1 = math.ceil(a * fps - 1e-6), math.ceil(b * fps - 1e-6)
+        if n1 <= n0: continue
+        if seg_idx is None:
+            chains.append(f"color=c=black:s={W}x{H}:r={fps},trim=end_frame={n1 - n0},setsar=1,format=yuv420p[p{k}]")
+        else:
+            # За концом исходника держим последний кадр, как source_time в бэкенде moviepy: кусок начинается не дальше него, дальше его тянет tpad
+            seg = segments[seg_idx]; seek = max(0.0, min(seg["in"] + n0 / fps - seg["start"], seg["source_duration"] - 1.0 / fps))
+            # -ss между кадрами начинает со следующего кадра исходника, а FFMPEG_VideoReader берет кадр int(fps*t) - округляем вниз так же
+            src_fps = seg.get("source_fps") or fps; seek = math.floor(seek * src_fps + 1e-5) / src_fps
+            inputs.append(["-ss", f"{seek:.6f}", "-t", f"{(n1 - n0 + 2) / fps:.6f}", "-i", seg["path"]])
+            chains.append(f"[{len(inputs) - 1}:v]setpts=PTS-STARTPTS,scale={W}:{H},setsar=1,fps={fps},tpad=stop_mode=clone:stop=-1,"
+                          f"trim=end_frame={n1 - n0},setpts=PTS-STARTPTS,format=yuv420p[p{k}]")
+        labels.append(f"[p{k}]")
+    chains.append(f"{''.join(labels)}concat=n={len(labels)}:v=1:a=0[base0]")
+    last = "base0"
+    for j, txt_e in enumerate(plan["texts"]):
+        try:
+            with profile_stage("text_png"): png = subtitle_png_path(txt_e["text"], txt_e["style"], png_dir)
+        except Exception as e_tc: print(f"    Ошибка растеризации текста: {e_tc}"); continue
+        with Image.open(png) as im: x, y = subtitle_overlay_xy(txt_e["style"], im.size, (W, H))
+        inputs.append(["-i", png])
+        t0, t1 = txt_e["start"], txt_e["start"] + txt_e["duration"]
+        chains.append(f"[{last}][{len(inputs) - 1}:v]overlay=x={x}:y={y}:enable='gte(t,{t0:.6f})*lt(t,{t1:.6f})'[base{j + 1}]"); last = f"base{j + 1}"
+    return inputs, ";\n".join(chains), last
+
+def render_plan_ffmpeg(plan, audio_filepath, output_filepath, threads=None, cache_dir=DEFAULT_CACHE_DIR, show_progress=True, preset=DEFAULT_X264_PRESET, audio_fade=0.0):
+    work_dir = tempfile.mkdtemp(prefix="montage_ffmpeg_")
+    png_dir = os.path.join(cache_dir, "text_png") if cache_dir else work_dir
+    try:
+        os.makedirs(png_dir, exist_ok=True)
+        print(f"Цель: FPS={plan['fps']}, Размер={tuple(plan['size'])} (бэкенд ffmpeg)")
+        inputs, graph, v_label = build_ffmpeg_filtergraph(plan, png_dir)
+        audio_args = ["-an"]
+        if audio_filepath:
+            inputs.append(ffmpeg_pcm_input_args(ensure_audio_pcm(audio_filepath, cache_dir))) # Зацикливание уже декодированной фоновой музыки
+            graph += f";\n[{len(inputs) - 1}:a]atrim=duration={plan['duration']:.6f},asetpts=PTS-STARTPTS{ffmpeg_audio_fade_filter(plan['duration'], audio_fade)}[aout]"
+            audio_args = ["-map", "[aout]", "-c:a", "aac", "-b:a", "192k"]
+        graph_path = os.path.join(work_dir, "filtergraph.txt")
+        with open(graph_path, 'w', encoding='utf-8') as f: f.write(graph)
+        cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", "-stats" if show_progress else "-nostats"] + [arg for in_args in inputs for arg in in_args] + [
+            "-filter_complex_script", graph_path, "-map", f"[{v_label}]"] + audio_args + [
+            "-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p", "-r", str(plan["fps"]), "-threads", str(threads or default_encoder_threads()),
+            "-t", f"{plan['duration']:.6f}", output_filepath]
+        print(f"Сохранение: {output_filepath}, FPS: {plan['fps']} (входов ffmpeg: {len(inputs)})")
+        if len(inputs) > FFMPEG_MANY_INPUTS: print(f"Предупреждение: {len(inputs)} одновременно открытых входов ffmpeg (по декодеру на каждый) - для длинных монтажей используйте --chunks.")
+        with profile_stage("encode"): proc = subprocess.run(cmd)
+        if proc.returncode != 0: print(f"Ошибка ffmpeg (код {proc.returncode})."); return False
+        return True
+    except Exception as e: print(f"Крит. ошибка монтажа: {e}"); traceback.print_exc(); return False
+    finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Рендер одного монтажа кусками: куски кодируются параллельно и склеиваются concat demuxer без перекодирования ---
+def slice_montage_plan(plan, t0, t1):
+    sub = dict(plan, duration=t1 - t0, segments=[], texts=[])
+    for seg in plan["segments"]:
+        a, b = max(seg["start"], t0), min(seg["start"] + seg["duration"], t1)
+        if b > a: sub["segments"].append(dict(seg, start=a - t0, duration=b - a, **{"in": seg["in"] + (a - seg["start"])}))
+    for txt_e in plan["texts"]:
+        a, b = max(txt_e["start"], t0), min(txt_e["start"] + txt_e["duration"], t1)
+        if b > a: sub["texts"].append(dict(txt_e, start=a - t0, duration=b - a))
+    return sub
+
+def split_montage_plan(plan, n_chunks):
+    # Разрезы - на границах сегментов (ближайших к равным долям), выровненных по сетке кадров,
+    # чтобы кадры кусков в сумме совпадали с кадрами цельного рендера
+    fps, duration = plan["fps"], plan["duration"]
+    total_frames = math.ceil(duration * fps - 1e-6)
+    boundaries = sorted({math.ceil(seg["start"] * fps - 1e-6) for seg in plan["segments"]} - {0})
+    cuts = [0]
+    for k in range(1, n_chunks):
+        target = total_frames * k / n_chunks
+        candidates = [f for f in boundaries if cuts[-1] < f < total_frames]
+        if candidates: cuts.append(min(candidates, key=lambda f: abs(f - target)))
+    cuts = sorted(set(cuts)) + [total_frames]
+    return [slice_montage_plan(plan, a / fps, (b / fps if b < total_frames else duration)) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+def render_chunk_job(chunk_job):
+    # Возвращает (успех, отчет профилирования куска или None)
+    plan, out_path, kwargs = chunk_job["plan"], chunk_job["output"], chunk_job["render_kwargs"]
+    profiler = StageProfiler() if chunk_job.get("profile") else None
+    with profiling(profiler):
+        if chunk_job["backend"] == "ffmpeg": ok = render_plan_ffmpeg(plan, None, out_path, **kwargs)
+        else: ok = render_plan_moviepy(plan, None, out_path, **kwargs)
+    return ok, (profiler.report() if profiler else None)
+
+def render_plan_chunked(plan, audio_filepath, output_filepath, n_chunks, backend="moviepy", text_renderer="pillow", threads=None, cache_dir=DEFAULT_CACHE_DIR, preset=DEFAULT_X264_PRESET, reader_options=None,
+                        audio_fade=0.0):
+    chunk_plans = split_montage_plan(plan, n_chunks)
+    chunk_threads = max(1, (threads or (os.cpu_count() or 2)) // len(chunk_plans))
+    work_dir = tempfile.mkdtemp(prefix="montage_chunks_", dir=os.path.dirname(os.path.abspath(output_filepath)))
+    chunk_durs = ", ".join("%.2fs" % cp["duration"] for cp in chunk_plans)
+    print(f"Рендер кусками: {len(chunk_plans)} шт. ({chunk_durs}), потоков кодировщика на кусок {chunk_threads}, preset {preset}")
+    try:
+        render_kwargs = {"threads": chunk_threads, "show_progress": False, "preset": preset, "cache_dir": cache_dir}
+        if backend != "ffmpeg": render_kwargs.update(reader_options or {}, text_renderer=text_renderer)
+        chunk_jobs = [{"plan": cp, "output": os.path.join(work_dir, f"chunk_{k:04d}.mp4"), "backend": backend, "render_kwargs": render_kwargs, "profile": _ACTIVE_PROFILER is not None}
+                      for k, cp in enumerate(chunk_plans)]
+        with profile_stage("render_chunks"), concurrent.futures.ProcessPoolExecutor(max_workers=len(chunk_jobs)) as pool: chunk_results = list(pool.map(render_chunk_job, chunk_jobs))
+        chunk_ok = [ok for ok, _ in chunk_results]
+        if _ACTIVE_PROFILER is not None: _ACTIVE_PROFILER.add_report([rep for _, rep in chunk_results if rep], "chunk.")
+        if not all(chunk_ok): print(f"Ошибка: Не отрендерены куски {[k for k, ok in enumerate(chunk_ok) if not ok]}."); return False
+        list_path = os.path.join(work_dir, "chunks.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for job in chunk_jobs: f.write("file '{}'\n".format(job["output"].replace("'", "'\\''")))
+        cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+        if audio_filepath:
+            cmd += ffmpeg_pcm_input_args(ensure_audio_pcm(audio_filepath, cache_dir)) + ["-map", "0:v:0", "-map", "1:a:0", "-c:a", "aac", "-b:a", "192k"]
+            if audio_fade > 0: cmd += ["-af", ffmpeg_audio_fade_filter(plan["duration"], audio_fade).lstrip(",")]
+        cmd += ["-c:v", "copy", "-t", f"{plan['duration']:.6f}", output_filepath]
+        with profile_stage("concat"): proc = subprocess.run(cmd)
+        if proc.returncode != 0: print(f"Ошибка склейки кусков ffmpeg (код {proc.returncode})."); return False
+        return True
+    except Exception as e: print(f"Крит. ошибка монтажа кусками: {e}"); traceback.print_exc(); return False
+    finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+def render_montage_plan(
+    plan, audio_filepath, output_filepath,
+    text_renderer="pillow", backend="moviepy", threads=None, cache_dir=DEFAULT_CACHE_DIR, show_progress=True,
+    chunks=1, preset=DEFAULT_X264_PRESET, reader_options=None, audio_fade=0.0
+):
+    # Рендер во временный файл рядом с итоговым: прерванный рендер не оставляет "почти готовый" монтаж
+    part_path = os.path.splitext(output_filepath)[0] + ".part.mp4"
+    if chunks and chunks > 1:
+        ok = render_plan_chunked(plan, audio_filepath, part_path, chunks, backend=backend, text_renderer=text_renderer, threads=threads, cache_dir=cache_dir, preset=preset, reader_options=reader_options,
+                                 audio_fade=audio_fade)
+    elif backend == "ffmpeg": ok = render_plan_ffmpeg(plan, audio_filepath, part_path, threads=threads, cache_dir=cache_dir, show_progress=show_progress, preset=preset, audio_fade=audio_fade)
+    else: ok = render_plan_moviepy(plan, audio_filepath, part_path, text_renderer=text_renderer, threads=threads, show_progress=show_progress, preset=preset,
+                                   cache_dir=cache_dir, audio_fade=audio_fade, **(reader_options or {}))
+    if not ok:
+        if os.path.exists(part_path): os.remove(part_path)
+        return False
+    os.replace(part_path, output_filepath); print(f"Сохранено: {output_filepath}")
+    return True
+
+def create_montage_from_subs_cli(
+    available_video_files_paths, audio_filepath, subtitle_ass_file, output_filepath,
+    max_allowed_duration=0, min_allowed_duration=0, source_video_clips_info=None, seed=None, **render_kwargs
+):
+    print(f"--- Монтаж по субтитрам --- Файл: {subtitle_ass_file}, Аудио: {audio_filepath}") # Сокращенный принт
+    subtitle_events, ass_styles = load_subtitles_cached(subtitle_ass_file)
+    if not subtitle_events: print("Ошибка: Нет событий субтитров."); return False
+    if source_video_clips_info is None: # Без общего кэша - probe только для этого монтажа
+        source_video_clips_info = build_source_video_clips_info(probe_media_files(available_video_files_paths, "video"))
+    if not source_video_clips_info: print("Ошибка: Нет видео для монтажа."); return False
+
+    plan = build_montage_plan(subtitle_events, ass_styles, source_video_clips_info, max_allowed_duration, rng=random.Random(seed))
+    if not check_montage_plan(plan, min_allowed_duration): return False
+    return render_montage_plan(plan, audio_filepath, output_filepath, **render_kwargs)
+
+# --- EDL (edit decision list): сериализуемый план монтажа, отдельно от рендера ---
+EDL_VERSION = 1
+EDL_SUFFIX = ".edl.json"
+
+def check_montage_plan(plan, min_allowed_duration=0):
+    montage_time = plan["duration"]
+    if min_allowed_duration and montage_time < min_allowed_duration: print(f"Ошибка: Длит. ({montage_time:.2f}s) < мин. ({min_allowed_duration}s)."); return False
+    if not plan["segments"]: print("Ошибка: Нет видео-сегментов."); return False
+    print(f"Событий: {plan['events_used']}. Длит. монтажа: {montage_time:.2f}s")
+    return True
+
+def derive_montage_seed(base_seed, index):
+    # Сид каждого монтажа зависит только от --seed и номера - любой монтаж пакета можно перепланировать отдельно
+    return int(hashlib.sha1(f"{base_seed}:{index}".encode('utf-8')).hexdigest()[:12], 16)
+
+def plan_montage_edl(index, seed, subtitle_ass_file, subtitle_events, ass_styles, source_video_clips_info, audio_files, audio_infos, output_dir,
+                     max_allowed_duration=0, min_allowed_duration=0, deterministic_name=False, target=None):
+    rng = random.Random(seed)
+    audio = rng.choice(audio_files)
+    plan = build_montage_plan(subtitle_events, ass_styles, source_video_clips_info, max_allowed_duration, rng=rng, target=target)
+    if not check_montage_plan(plan, min_allowed_duration): return None
+    subs_basename = os.path.splitext(os.path.basename(subtitle_ass_file))[0]
+    audio_basename = os.path.splitext(os.path.basename(audio))[0]
+    tag = f"s{seed}" if deterministic_name else time.strftime("%H%M%S")
+    output_filename = f"montage_subs_{subs_basename}_audio_{audio_basename}_{tag}_{index+1}.mp4"
+    return dict(plan, version=EDL_VERSION, index=index, seed=seed, subtitle_ass_file=subtitle_ass_file, audio=audio, audio_info=audio_infos.get(audio),
+                output=os.path.join(output_dir, output_filename))
+
+def edl_path_for(edl, edl_dir): return os.path.join(edl_dir, os.path.splitext(os.path.basename(edl["output"]))[0] + EDL_SUFFIX)
+
+def save_edl(edl, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(edl, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_edls(path):
+    # Файл .edl.json, файл .jsonl (по EDL на строку) или папка с .edl.json
+    if os.path.isdir(path): files = sorted(os.path.join(path, f_name) for f_name in os.listdir(path) if f_name.endswith(EDL_SUFFIX))
+    else: files = [path]
+    edls = []
+    for f_path in files:
+        with open(f_path, 'r', encoding='utf-8') as f:
+            if f_path.endswith(".jsonl"): edls += [json.loads(line) for line in f if line.strip()]
+            else: edls.append(json.load(f))
+    for edl in edls:
+        if edl.get("version") != EDL_VERSION: raise ValueError(f"Неподдерживаемая версия EDL {edl.get('version')} ({edl.get('output')})")
+    return sorted(edls, key=lambda edl: edl["index"])
+
+def resolve_edl_paths(edl):
+    # Прокси из EDL может не быть на этой машине (шардинг) - тогда читаем оригинал
+    for seg in edl["segments"]:
+        if not os.path.exists(seg["path"]) and seg.get("source") and os.path.exists(seg["source"]): seg["path"] = seg["source"]
+    return edl
+
+def is_valid_montage_output(path, expected_duration, fps=30.0):
+    if not os.path.exists(path) or os.path.getsize(path) == 0: return False
+    try: info = probe_media_file(path, "video")
+    except Exception: return False
+    return abs((info.get("duration") or 0.0) - expected_duration) <= max(0.25, 2.0 / (fps or 30.0))
+
+def parse_shard(shard_str):
+    try:
+        k, m = (int(x) for x in shard_str.split('/'))
+        if m > 0 and 0 <= k < m: return k, m
+    except ValueError: pass
+    raise argparse.ArgumentTypeError(f"ожидается K/M (0 <= K < M), получено '{shard_str}'")
+
+# --- Пакетный рендер: пул процессов, у каждого воркера свои теплые кэши (субтитры, probe, текст) ---
+PROFILE_SUFFIX = ".profile.json"
+
+def run_montage_job(job):
+    edl = resolve_edl_paths(job["edl"])
+    start_time = time.time(); error = None
+    profiler = StageProfiler() if job.get("profile") else None
+    try:
+        print(f"--- Рендер EDL #{edl['index']+1} --- Субтитры: {edl['subtitle_ass_file']}, Аудио: {edl['audio']}, сид {edl['seed']}")
+        with profiling(profiler): success = render_montage_plan(edl, edl["audio"], edl["output"], **job["render_kwargs"])
+    except Exception as e: traceback.print_exc(); success = False; error = str(e)
+    if profiler: save_montage_profile(profiler, edl, job["render_kwargs"], bool(success))
+    return {"index": job["index"], "output": edl["output"], "success": bool(success), "elapsed": time.time() - start_time, "error": error}
+
+def save_montage_profile(profiler, edl, render_kwargs, success):
+    frames = int(round(edl["duration"] * edl["fps"]))
+    rep = profiler.report(output=edl["output"], index=edl["index"], seed=edl["seed"], success=success, duration=edl["duration"], frames=frames,
+                          segments=len(edl["segments"]), texts=len(edl["texts"]), pid=os.getpid(),
+                          config={k: v for k, v in render_kwargs.items() if k != "show_progress"})
+    rep["fps"] = round(frames / rep["wall_total"], 2) if rep["wall_total"] > 0 else None
+    encode_wall = sum(st["wall"] for name, st in rep["stages"].items() if name in ("encode", "render_chunks", "concat"))
+    rep["encode_fps"] = round(frames / encode_wall, 2) if encode_wall > 0 else None
+    profile_path = os.path.splitext(edl["output"])[0] + PROFILE_SUFFIX
+    try: write_json_atomic(profile_path, rep); print(f"Профиль: {profile_path} ({rep['wall_total']:.2f} сек., {rep['fps']} кадр/сек)")
+    except Exception as e: print(f"Предупреждение: Не удалось сохранить профиль '{profile_path}': {e}")
+
+def _report_job_result(res, total):
+    if res["success"]: print(f"Монтаж #{res['index']+1}/{total} создан за {res['elapsed']:.2f} сек.")
+    else: print(f"Ошибка создания монтажа #{res['index']+1}/{total}." + (f" {res['error']}" if res.get("error") else ""))
+
+def _init_montage_worker():
+    # Ctrl+C/SIGTERM приходят всей группе процессов: останавливает воркеры родитель, а не сигнал (и без обработчика сервиса)
+    signal.signal(signal.SIGINT, signal.SIG_IGN); signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+class MontageWorkerPool:
+    # Пул процессов рендера, который может пережить пакет: в режиме --serve воркеры и их кэши (шрифты, картинки текста) живут между заданиями
+    def __init__(self, n_workers):
+        self.n_workers = max(1, n_workers); self.executor = None
+
+    def get(self):
+        if self.executor is None: self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_montage_worker)
+        return self.executor
+
+    def reset(self):
+        # Воркер упал - пул сломан, следующий get() создаст новый
+        if self.executor: self.executor.shutdown(wait=False)
+        self.executor = None
+
+    def shutdown(self, cancel_futures=False):
+        # cancel_futures: задания из очереди пула не запускать (прерывание), дождаться только уже выполняющихся
+        if self.executor:
+            if cancel_futures and sys.version_info >= (3, 9): self.executor.shutdown(wait=True, cancel_futures=True)
+            else: self.executor.shutdown(wait=True)
+        self.executor = None
+
+def run_montage_jobs(jobs, n_jobs=1, worker_pool=None):
+    # Возвращает результаты в порядке jobs; падение одного задания (и даже воркера) не останавливает остальные
+    results = [None] * len(jobs)
+    if n_jobs <= 1 and worker_pool is None:
+        for pos, job in enumerate(jobs):
+            print(f"\n--- Создание видеомонтажа #{job['index']+1}/{len(jobs)} (по субтитрам) ---")
+            results[pos] = run_montage_job(job); _report_job_result(results[pos], len(jobs))
+        return results
+    own_pool = worker_pool is None
+    if own_pool: worker_pool = MontageWorkerPool(min(n_jobs, len(jobs)))
+    # В пул отдается не больше заданий, чем воркеров: при прерывании ждать приходится только уже выполняющиеся
+    pending = list(range(len(jobs))); attempts = {}; waiting = collections.deque(); futures = {}
+    try:
+        while pending:
+            crashed = []; waiting = collections.deque(pending)
+            while waiting or futures:
+                while waiting and len(futures) < worker_pool.n_workers:
+                    pos = waiting.popleft()
+                    try: futures[worker_pool.get().submit(run_montage_job, jobs[pos])] = pos
+                    except concurrent.futures.process.BrokenProcessPool: crashed += [pos] + list(waiting); waiting.clear()
+                if not futures: break
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    pos = futures.pop(fut)
+                    try: results[pos] = fut.result()
+                    except concurrent.futures.process.BrokenProcessPool: crashed.append(pos); continue
+                    except Exception as e: results[pos] = {"index": jobs[pos]["index"], "output": jobs[pos]["edl"]["output"], "success": False, "elapsed": 0.0, "error": str(e)}
+                    _report_job_result(results[pos], len(jobs))
+            if crashed: worker_pool.reset()
+            # Воркер упал - задания, попавшие под сломанный пул, перезапускаются в новом пуле один раз
+            pending = []
+            for pos in crashed:
+                attempts[pos] = attempts.get(pos, 0) + 1
+                if attempts[pos] < 2: pending.append(pos)
+                else: results[pos] = {"index": jobs[pos]["index"], "output": jobs[pos]["edl"]["output"], "success": False, "elapsed": 0.0, "error": "процесс воркера аварийно завершился"}; _report_job_result(results[pos], len(jobs))
+            if pending: print(f"Пул процессов сломан, перезапуск {len(pending)} заданий...")
+    except KeyboardInterrupt:
+        # Ctrl+C/SIGTERM: задания, которые еще не начались, отменяются; дожидаемся только уже выполняющихся
+        cancelled = list(waiting) + [pos for fut, pos in futures.items() if fut.cancel()]
+        for pos in cancelled: results[pos] = {"index": jobs[pos]["index"], "output": jobs[pos]["edl"]["output"], "success": False, "elapsed": 0.0, "error": "отменено"}
+        running = sum(1 for fut in futures if not fut.done())
+        print(f"\nПрерывание: отменено заданий {len(cancelled)}, не создано {sum(1 for res in results if not res or not res['success'])} из {len(jobs)}"
+              + (f", ожидание {running} выполняющихся..." if running else "."))
+        if own_pool: worker_pool.shutdown(cancel_futures=True); own_pool = False
+        raise
+    finally:
+        if own_pool: worker_pool.shutdown()
+    return results
+
 def find_files(directory, extensions):
     found_files = []
     if directory and os.path.isdir(directory):
-        for f_name in os.listdir(directory):
+        for f_name in sorted(os.listdir(directory)): # Порядок нужен стабильным: от него зависят EDL с тем же --seed
             if any(f_name.lower().endswith(ext.lower()) for ext in extensions):
                 found_files.append(os.path.join(directory, f_name))
     return found_files
 
-if __name__ == "__main__":
+def build_arg_parser():
     parser = argparse.ArgumentParser(description="Создает видеомонтажи по файлу субтитров.")
-    parser.add_argument("-vd", "--video_dir", required=True, help="Папка с исходными видеофайлами.")
-    parser.add_argument("-ad", "--audio_dir", required=True, help="Папка с аудиофайлами для фона.")
-    parser.add_argument("-sub", "--subtitle_ass_file", required=True, help="Путь к файлу субтитров .ASS.")
-    parser.add_argument("-od", "--output_dir", required=True, help="Папка для сохранения.")
+    parser.add_argument("-vd", "--video_dir", help="Папка с исходными видеофайлами.")
+    parser.add_argument("-ad", "--audio_dir", help="Папка с аудиофайлами для фона.")
+    parser.add_argument("-sub", "--subtitle_ass_file", help="Путь к файлу субтитров .ASS.")
+    parser.add_argument("-od", "--output_dir", help="Папка для сохранения.")
     parser.add_argument("-n", "--num_montages", type=int, default=1, help="Количество монтажей.")
     parser.add_argument("-max_dur", "--max_duration", type=int, default=0, help="Макс. длительность (сек, 0=без огр.).")
     parser.add_argument("-min_dur", "--min_duration", type=int, default=0, help="Мин. длительность (сек, 0=нет проверки).")
-    
-    args = parser.parse_args()
-
-    if not os.path.isdir(args.video_dir): sys.exit(f"Ошибка: Папка видео не найдена: {args.video_dir}")
-    if not os.path.isdir(args.audio_dir): sys.exit(f"Ошибка: Папка аудио не найдена: {args.audio_dir}")
-    if not os.path.exists(args.subtitle_ass_file): sys.exit(f"Ошибка: Файл субтитров не найден: {args.subtitle_ass_file}")
-    if not os.path.exists(args.output_dir):
-        try: os.makedirs(args.output_dir); print(f"Создана директория: {args.output_dir}")
-        except Exception as e: sys.exit(f"Ошибка создания директории '{args.output_dir}': {e}")
+    parser.add_argument("--seed", type=int, default=None, help="Базовый сид: одинаковый сид дает одинаковые EDL и имена файлов (повтор и досборка пакета).")
+    parser.add_argument("--plan_only", action="store_true", help="Только спланировать EDL (без декодирования и рендера) и выйти.")
+    parser.add_argument("--render_edl", default=None, help="Только рендер: путь к .edl.json, .jsonl или папке с EDL (папки видео/аудио/субтитров не нужны).")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Рендерить только EDL с номером index %% M == K (формат K/M) - для раздачи пакета по машинам.")
+    parser.add_argument("--overwrite", action="store_true", help="Рендерить заново, даже если готовый файл уже есть и валиден.")
+    parser.add_argument("--text_renderer", choices=["pillow", "imagemagick"], default="pillow", help="Чем рисовать текст субтитров: pillow (в процессе, с кэшем) или imagemagick (TextClip).")
+    parser.add_argument("--backend", choices=["moviepy", "ffmpeg"], default="moviepy", help="Рендер: moviepy (эталонный, покадровая композиция в Python) или ffmpeg (один filtergraph в ffmpeg).")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Сколько монтажей рендерить параллельно (процессов).")
+    parser.add_argument("--chunks", type=int, default=1, help="Резать один монтаж на N кусков по границам сегментов и кодировать их параллельно (склейка без перекодирования).")
+    parser.add_argument("--preset", default=DEFAULT_X264_PRESET, help=f"Пресет x264 (ultrafast ... veryslow), по умолч. {DEFAULT_X264_PRESET}.")
+    parser.add_argument("--audio_fade", type=float, default=0.0, help="Плавное нарастание и затухание фоновой музыки в начале и в конце монтажа, сек. (0 = выкл.).")
+    parser.add_argument("--proxies", action="store_true", help="Один раз перекодировать исходники в кэшируемые прокси с целевыми размером/FPS и частыми ключевыми кадрами и монтировать из них.")
+    parser.add_argument("--proxy_cache_max_gb", type=float, default=DEFAULT_PROXY_CACHE_MAX_GB, help=f"Лимит размера кэша прокси в ГБ (по умолч. {DEFAULT_PROXY_CACHE_MAX_GB:g}), старые прокси удаляются.")
+    parser.add_argument("--max_open_readers", type=int, default=DEFAULT_MAX_OPEN_READERS, help=f"Бэкенд moviepy: максимум одновременно открытых исходников (процессов ffmpeg), по умолч. {DEFAULT_MAX_OPEN_READERS}.")
+    parser.add_argument("--prefetch_threads", type=int, default=DEFAULT_PREFETCH_THREADS, help=f"Бэкенд moviepy: потоков фонового декодирования сегментов (0 = выкл.), по умолч. {DEFAULT_PREFETCH_THREADS}.")
+    parser.add_argument("--prefetch_frames", type=int, default=DEFAULT_PREFETCH_FRAMES, help=f"Бэкенд moviepy: размер очереди кадров на поток предзагрузки, по умолч. {DEFAULT_PREFETCH_FRAMES}.")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help=f"Папка для кэшей между запусками (по умолч. {DEFAULT_CACHE_DIR}, пустая строка = без кэша на диске).")
+    parser.add_argument("--probe_workers", "--probe-workers", type=int, default=1, help="Потоков для probe новых медиафайлов.")
+    parser.add_argument("--profile", action="store_true", help="Писать JSON-отчет профилирования рядом с каждым монтажом (<имя>.profile.json) и для планирования (edl/plan.profile.json).")
+    parser.add_argument("--serve", action="store_true", help="Режим сервиса: не выходить, а выполнять задания из очереди --spool_dir (импорты, кэши и пул воркеров остаются в памяти).")
+    parser.add_argument("--submit", action="store_true", help="Не выполнять самому, а поставить задание с этими параметрами в очередь сервиса --spool_dir.")
+    parser.add_argument("--wait", action="store_true", help="С --submit: дождаться завершения задания и вывести итог.")
+    parser.add_argument("--status", nargs="?", const="", default=None, metavar="JOB_ID", help="Показать статус сервиса и длину очереди (или статус задания JOB_ID) и выйти.")
+    parser.add_argument("--spool_dir", default=DEFAULT_SPOOL_DIR, help=f"Папка очереди заданий сервиса (по умолч. {DEFAULT_SPOOL_DIR}).")
+    return parser
 
+def plan_montage_batch(args):
+    # Стадия планирования: probe (из кэша) + разбор субтитров + сид -> EDL на каждый монтаж. Декодирования нет.
     video_extensions = ['.mp4', '.mov', '.avi', '.mkv', '.webm']
     audio_extensions = ['.mp3', '.wav', '.aac', '.ogg', '.flac']
 
@@ -275,30 +1342,278 @@ if __name__ == "__main__":
     if not all_input_audio_files: sys.exit(f"Аудиофайлы не найдены в {args.audio_dir}")
 
     print(f"Найдено видео: {len(all_input_video_files)}, аудио: {len(all_input_audio_files)}")
-    
-    processed_montages = 0; total_start_time = time.time()
-
-    for i in range(args.num_montages):
-        print(f"\n--- Создание видеомонтажа #{i+1}/{args.num_montages} (по субтитрам) ---")
-        chosen_audio_for_montage = random.choice(all_input_audio_files)
-        print(f"Аудио для монтажа #{i+1}: {os.path.basename(chosen_audio_for_montage)}")
-
-        audio_basename = os.path.splitext(os.path.basename(chosen_audio_for_montage))[0]
-        subs_basename = os.path.splitext(os.path.basename(args.subtitle_ass_file))[0]
-        timestamp_str = time.strftime("%H%M%S")
-        output_filename = f"montage_subs_{subs_basename}_audio_{audio_basename}_{timestamp_str}_{i+1}.mp4"
-        output_filepath = os.path.join(args.output_dir, output_filename)
-        
-        single_montage_start_time = time.time()
-        success = create_montage_from_subs_cli(
-            all_input_video_files, chosen_audio_for_montage, args.subtitle_ass_file,
-            output_filepath, max_allowed_duration=args.max_duration, min_allowed_duration=args.min_duration
-        )
-        single_montage_end_time = time.time()
-
-        if success: processed_montages +=1; print(f"Монтаж #{i+1} создан за {single_montage_end_time - single_montage_start_time:.2f} сек.")
-        else: print(f"Ошибка создания монтажа #{i+1}.")
-
-    total_end_time = time.time()
+
+    profiler = StageProfiler() if args.profile else None
+    with profiling(profiler):
+        probe_cache_path = os.path.join(args.cache_dir, "probe_cache.json") if args.cache_dir else ""
+        with profile_stage("probe"):
+            probe_cache = load_probe_cache(probe_cache_path)
+            source_video_clips_info = build_source_video_clips_info(probe_media_files(all_input_video_files, "video", probe_cache, args.probe_workers))
+            audio_infos = {info["path"]: info for info in probe_media_files(all_input_audio_files, "audio", probe_cache, args.probe_workers) if info}
+        if not source_video_clips_info: sys.exit("Ошибка: Нет видео для монтажа.")
+        target = target_video_profile(source_video_clips_info)
+        if args.proxies:
+            with profile_stage("proxies"):
+                source_video_clips_info = prepare_source_proxies(source_video_clips_info, args.cache_dir, probe_cache, args.probe_workers, args.proxy_cache_max_gb * 1024**3, target=target)
+        save_probe_cache(probe_cache_path, probe_cache)
+        usable_audio_files = [p for p in all_input_audio_files if p in audio_infos]
+        if not usable_audio_files: sys.exit("Ошибка: Нет читаемых аудиофайлов.")
+
+        with profile_stage("parse_subtitles"): subtitle_events, ass_styles = load_subtitles_cached(args.subtitle_ass_file, args.cache_dir)
+        if not subtitle_events: sys.exit("Ошибка: Нет событий субтитров.")
+
+        edl_dir = os.path.join(args.output_dir, "edl"); os.makedirs(edl_dir, exist_ok=True)
+        base_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2**32)
+        plan_start_time = time.time(); edls = []
+        with profile_stage("plan"):
+            for i in range(args.num_montages):
+                edl = plan_montage_edl(i, derive_montage_seed(base_seed, i), args.subtitle_ass_file, subtitle_events, ass_styles, source_video_clips_info,
+                                       usable_audio_files, audio_infos, args.output_dir, args.max_duration, args.min_duration, deterministic_name=args.seed is not None, target=target)
+                if not edl: print(f"Монтаж #{i+1} не спланирован."); continue
+                save_edl(edl, edl_path_for(edl, edl_dir)); edls.append(edl)
+        if not args.plan_only:
+            with profile_stage("decode_audio"): prepare_audio_cache([edl["audio"] for edl in edls], args.cache_dir, args.probe_workers)
+    print(f"Спланировано EDL: {len(edls)} из {args.num_montages} за {time.time() - plan_start_time:.2f} сек. (сид {base_seed}, папка {edl_dir})")
+    if profiler: # Планирование общее для пакета - отдельный отчет рядом с EDL
+        write_json_atomic(os.path.join(edl_dir, "plan" + PROFILE_SUFFIX), profiler.report(seed=base_seed, videos=len(all_input_video_files), audios=len(all_input_audio_files),
+                                                                                       subtitle_events=len(subtitle_events), planned=len(edls)))
+    return edls
+
+def render_montage_batch(args, edls, worker_pool=None):
+    if args.shard:
+        k, m = args.shard; edls = [edl for edl in edls if edl["index"] % m == k]
+        print(f"Шард {k}/{m}: EDL к рендеру {len(edls)}")
+    pending = []
+    for edl in edls:
+        if not args.overwrite and is_valid_montage_output(edl["output"], edl["duration"], edl["fps"]): print(f"Пропуск #{edl['index']+1}: уже готов {os.path.basename(edl['output'])}")
+        else: pending.append(edl)
+    skipped = len(edls) - len(pending)
+
+    n_jobs = max(1, min(args.jobs, len(pending) or 1))
+    # Потоки кодировщика делим между воркерами, чтобы пул не перегружал CPU
+    encoder_threads = max(1, (os.cpu_count() or 2) // n_jobs) if n_jobs > 1 else default_encoder_threads()
+    if n_jobs > 1: print(f"Параллельный рендер: воркеров {n_jobs}, потоков кодировщика на воркер {encoder_threads}")
+    render_kwargs = {"text_renderer": args.text_renderer, "backend": args.backend, "cache_dir": args.cache_dir, "threads": encoder_threads,
+                     "show_progress": n_jobs == 1, "chunks": args.chunks, "preset": args.preset, "audio_fade": args.audio_fade,
+                     "reader_options": {"max_open_readers": args.max_open_readers, "prefetch_threads": args.prefetch_threads, "prefetch_frames": args.prefetch_frames}}
+    jobs = [{"index": edl["index"], "edl": edl, "render_kwargs": render_kwargs, "profile": args.profile} for edl in pending]
+
+    total_start_time = time.time()
+    results = run_montage_jobs(jobs, n_jobs, worker_pool if n_jobs > 1 else None)
+    processed_montages = sum(1 for res in results if res and res["success"])
+    total_end_time = time.time(); total_elapsed = total_end_time - total_start_time
+
     print(f"\n--- Завершено ---")
-    print(f"Успешно создано: {processed_montages} из {args.num_montages}. Общее время: {total_end_time - total_start_time:.2f} сек.")
\ No newline at end of file
+    for res in results:
+        if res and not res["success"]: print(f"  Не создан #{res['index']+1}: {os.path.basename(res['output'])}" + (f" ({res['error']})" if res.get("error") else ""))
+    print(f"Успешно создано: {processed_montages} из {len(jobs)} (уже были готовы: {skipped}). Общее время: {total_elapsed:.2f} сек.")
+    if total_elapsed > 0: print(f"Пропускная способность: {processed_montages / total_elapsed * 3600:.1f} монтажей/час (воркеров: {n_jobs}).")
+    return results
+
+def check_montage_args(args):
+    if args.render_edl:
+        if not os.path.exists(args.render_edl): sys.exit(f"Ошибка: EDL не найден: {args.render_edl}")
+        return
+    for name in ("video_dir", "audio_dir", "subtitle_ass_file", "output_dir"):
+        if not getattr(args, name): sys.exit(f"Ошибка: Не указан обязательный аргумент --{name} (или используйте --render_edl).")
+    if not os.path.isdir(args.video_dir): sys.exit(f"Ошибка: Папка видео не найдена: {args.video_dir}")
+    if not os.path.isdir(args.audio_dir): sys.exit(f"Ошибка: Папка аудио не найдена: {args.audio_dir}")
+    if not os.path.exists(args.subtitle_ass_file): sys.exit(f"Ошибка: Файл субтитров не найден: {args.subtitle_ass_file}")
+
+def run_montage_cli(args, worker_pool=None):
+    check_montage_args(args)
+    if args.render_edl:
+        try: edls = load_edls(args.render_edl)
+        except Exception as e: sys.exit(f"Ошибка чтения EDL '{args.render_edl}': {e}")
+        print(f"Загружено EDL: {len(edls)}")
+        for out_dir in {os.path.dirname(edl["output"]) for edl in edls}:
+            if out_dir: os.makedirs(out_dir, exist_ok=True)
+        return render_montage_batch(args, edls, worker_pool)
+
+    if not os.path.exists(args.output_dir):
+        try: os.makedirs(args.output_dir); print(f"Создана директория: {args.output_dir}")
+        except Exception as e: sys.exit(f"Ошибка создания директории '{args.output_dir}': {e}")
+
+    edls = plan_montage_batch(args)
+    if args.plan_only: return edls
+    return render_montage_batch(args, edls, worker_pool)
+
+# --- Режим сервиса: долгоживущий процесс берет задания из папки-очереди (spool), импорты и кэши остаются теплыми ---
+# <spool_dir>/incoming/<id>.json - очередь, running/ - задания в работе, jobs/<id>.json - статус задания, service.json - статус сервиса
+DEFAULT_SPOOL_DIR = ".montage_spool"
+SPOOL_POLL_INTERVAL = 0.5
+SPOOL_HEARTBEAT_INTERVAL = 5.0
+SPOOL_STALE_AFTER = 4 * SPOOL_HEARTBEAT_INTERVAL # Столько без обновления service.json - сервис считается упавшим
+# Эти параметры задает сам сервис (общие кэши и пул воркеров), из задания они не берутся
+SERVICE_ARG_NAMES = ("serve", "submit", "status", "wait", "spool_dir", "cache_dir", "jobs", "probe_workers")
+SPOOL_PATH_ARG_NAMES = ("video_dir", "audio_dir", "subtitle_ass_file", "output_dir", "render_edl")
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def read_json_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError): return None
+
+def spool_paths(spool_dir):
+    paths = {name: os.path.join(spool_dir, name) for name in ("incoming", "running", "jobs")}
+    for d in paths.values(): os.makedirs(d, exist_ok=True)
+    paths["service"] = os.path.join(spool_dir, "service.json")
+    return paths
+
+def spool_queue(paths): return sorted(f_name for f_name in os.listdir(paths["incoming"]) if f_name.endswith(".json"))
+
+def update_job_status(paths, job_id, **fields):
+    status_path = os.path.join(paths["jobs"], f"{job_id}.json")
+    status = read_json_file(status_path) or {"id": job_id}
+    status.update(fields); write_json_atomic(status_path, status)
+    return status
+
+def submit_montage_job(args):
+    check_montage_args(args)
+    paths = spool_paths(args.spool_dir)
+    job_args = {k: v for k, v in vars(args).items() if k not in SERVICE_ARG_NAMES}
+    for name in SPOOL_PATH_ARG_NAMES: # Сервис может быть запущен из другой папки
+        if job_args.get(name): job_args[name] = os.path.abspath(job_args[name])
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{random.SystemRandom().randrange(16**4):04x}"
+    queue_depth = len(spool_queue(paths))
+    update_job_status(paths, job_id, state="queued", submitted_at=time.time())
+    write_json_atomic(os.path.join(paths["incoming"], f"{job_id}.json"), {"id": job_id, "submitted_at": time.time(), "args": job_args})
+    print(f"Задание {job_id} поставлено в очередь {args.spool_dir} (перед ним в очереди: {queue_depth}).")
+    if not args.wait: return job_id
+    while True:
+        status = read_json_file(os.path.join(paths["jobs"], f"{job_id}.json")) or {}
+        if status.get("state") in ("done", "failed"): break
+        service = read_json_file(paths["service"]) or {}
+        if service.get("state") == "stopped" or time.time() - service.get("updated_at", time.time()) > SPOOL_STALE_AFTER:
+            sys.exit(f"Ошибка: Сервис {args.spool_dir} остановлен или не отвечает, задание {job_id} в состоянии {status.get('state', '?')}.")
+        time.sleep(SPOOL_POLL_INTERVAL)
+    print_job_status(status)
+    if status["state"] == "failed": sys.exit(1)
+    return job_id
+
+def print_job_status(status):
+    print(f"Задание {status['id']}: {status.get('state', '?')}")
+    if status.get("started_at") and status.get("finished_at"): print(f"  Время выполнения: {status['finished_at'] - status['started_at']:.2f} сек.")
+    result = status.get("result") or {}
+    if "planned" in result: print(f"  Спланировано EDL: {result['planned']}")
+    if "rendered" in result: print(f"  Успешно создано: {result['rendered']} из {result['total']}")
+    for out in result.get("failed_outputs", []): print(f"  Не создан: {out}")
+    if status.get("error"): print(f"  Ошибка: {status['error']}")
+
+def print_service_status(args):
+    paths = spool_paths(args.spool_dir)
+    if args.status: # Статус конкретного задания
+        status = read_json_file(os.path.join(paths["jobs"], f"{args.status}.json"))
+        if not status: sys.exit(f"Задание не найдено: {args.status}")
+        print_job_status(status); return status
+    service = read_json_file(paths["service"])
+    queued = spool_queue(paths)
+    if not service: print(f"Сервис для {args.spool_dir} не запускался.")
+    else:
+        print(f"Сервис: pid {service['pid']}, состояние {service['state']}, обновлено {time.time() - service['updated_at']:.0f} сек. назад")
+        if service.get("current_job"): print(f"  Выполняется: {service['current_job']}")
+        print(f"  Выполнено заданий: {service['jobs_done']}, с ошибкой: {service['jobs_failed']}")
+    print(f"  Заданий в очереди: {len(queued)}" + (f" (следующее: {os.path.splitext(queued[0])[0]})" if queued else ""))
+    return service
+
+def claim_next_spool_job(paths):
+    # Перенос incoming -> running атомарен: одну очередь могут разбирать несколько сервисов
+    for f_name in spool_queue(paths):
+        running_path = os.path.join(paths["running"], f_name)
+        try: os.replace(os.path.join(paths["incoming"], f_name), running_path)
+        except FileNotFoundError: continue
+        return running_path
+    return None
+
+def finish_spooled_job(paths, job_id, running_path, state, result=None, error=None):
+    update_job_status(paths, job_id, state=state, finished_at=time.time(), result=result, error=error)
+    try: os.remove(running_path)
+    except OSError: pass
+
+def _pid_alive(pid):
+    if not pid or os.name == "nt": return False # В Windows os.kill(pid, 0) завершает процесс - там задание считаем брошенным
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except OSError: return True # Процесс есть, но чужой
+    return True
+
+def fail_stale_spool_jobs(paths):
+    # Задания из running/, чей сервис упал: помечаются failed (клиент --wait получает ответ), заново не запускаются -
+    # задание само могло уронить сервис. Задания живых сервисов на той же очереди не трогаем.
+    for f_name in sorted(os.listdir(paths["running"])):
+        if not f_name.endswith(".json"): continue
+        job_id = os.path.splitext(f_name)[0]
+        status = read_json_file(os.path.join(paths["jobs"], f"{job_id}.json")) or {}
+        if _pid_alive(status.get("service_pid")): continue
+        print(f"ПРЕДУПРЕЖДЕНИЕ: Задание {job_id} осталось незавершенным после остановки сервиса (pid {status.get('service_pid', '?')}), помечено failed.")
+        finish_spooled_job(paths, job_id, os.path.join(paths["running"], f_name), "failed", error="сервис завершился во время выполнения задания")
+
+def run_spooled_job(job, service_args, worker_pool):
+    args = build_arg_parser().parse_args([])
+    for k, v in job.get("args", {}).items():
+        if hasattr(args, k) and k not in SERVICE_ARG_NAMES: setattr(args, k, v)
+    if args.shard: args.shard = tuple(args.shard)
+    args.cache_dir, args.jobs, args.probe_workers = service_args.cache_dir, service_args.jobs, service_args.probe_workers
+    out = run_montage_cli(args, worker_pool)
+    if args.plan_only: return {"planned": len(out)}
+    return {"rendered": sum(1 for res in out if res and res["success"]), "total": len(out),
+            "outputs": [res["output"] for res in out if res and res["success"]], "failed_outputs": [res["output"] for res in out if res and not res["success"]]}
+
+def _raise_keyboard_interrupt(signum, frame): raise KeyboardInterrupt()
+
+def serve_montage_jobs(args):
+    paths = spool_paths(args.spool_dir)
+    fail_stale_spool_jobs(paths)
+    load_moviepy() # Прогрев импортов один раз на весь срок жизни сервиса
+    worker_pool = MontageWorkerPool(args.jobs) if args.jobs > 1 else None
+    service = {"pid": os.getpid(), "started_at": time.time(), "state": "idle", "current_job": None, "jobs_done": 0, "jobs_failed": 0}
+    status_lock = threading.Lock(); stop_heartbeat = threading.Event()
+    def write_service_status(**fields):
+        with status_lock: service.update(fields, updated_at=time.time(), queue_depth=len(spool_queue(paths))); write_json_atomic(paths["service"], service)
+    def heartbeat():
+        # Отдельный поток: service.json обновляется и во время долгого задания, клиенты --wait по нему видят, что сервис жив
+        while not stop_heartbeat.wait(SPOOL_HEARTBEAT_INTERVAL): write_service_status()
+    write_service_status()
+    threading.Thread(target=heartbeat, daemon=True).start()
+    # SIGTERM (остановка оркестратором) обрабатываем как Ctrl+C: статус сервиса и пул воркеров закрываются штатно
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    print(f"Сервис запущен (pid {os.getpid()}): очередь {paths['incoming']}, воркеров {args.jobs}, кэш {args.cache_dir or '-'}. Остановка: Ctrl+C")
+    try:
+        while True:
+            running_path = claim_next_spool_job(paths)
+            if not running_path: time.sleep(SPOOL_POLL_INTERVAL); continue
+            job = read_json_file(running_path) or {}
+            job_id = job.get("id") or os.path.splitext(os.path.basename(running_path))[0]
+            write_service_status(state="busy", current_job=job_id)
+            update_job_status(paths, job_id, state="running", started_at=time.time(), service_pid=os.getpid())
+            print(f"\n=== Задание {job_id} (в очереди еще {service['queue_depth']}) ===")
+            state, result, error = "failed", None, None
+            try:
+                result = run_spooled_job(job, args, worker_pool)
+                state = "failed" if result.get("failed_outputs") else "done"
+            except SystemExit as e: error = str(e.code) # Ошибки аргументов/входных данных: как у CLI, но сервис продолжает работу
+            except Exception as e: traceback.print_exc(); error = str(e)
+            except KeyboardInterrupt: finish_spooled_job(paths, job_id, running_path, "failed", error="сервис остановлен во время выполнения задания"); raise
+            finish_spooled_job(paths, job_id, running_path, state, result, error)
+            service["jobs_done" if state == "done" else "jobs_failed"] += 1
+            print(f"=== Задание {job_id}: {state} ===")
+            write_service_status(state="idle", current_job=None)
+    except KeyboardInterrupt: print("\nОстановка сервиса...")
+    finally:
+        if worker_pool: worker_pool.shutdown(cancel_futures=True)
+        stop_heartbeat.set(); write_service_status(state="stopped", current_job=None)
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.serve: return serve_montage_jobs(args)
+    if args.status is not None: return print_service_status(args)
+    if args.submit: return submit_montage_job(args)
+    try: return run_montage_cli(args)
+    except KeyboardInterrupt: sys.exit("Прервано.")
+
+if __name__ == "__main__":
+    main()
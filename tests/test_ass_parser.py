@@ -0,0 +1,58 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main_cli
+
+STYLES = """[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,2,1,2,10,10,30,1
+Style: Top,Arial,36,&H0000FFFF,&H000000FF,&H00202020,&H80000000,-1,0,0,0,100,100,0,0,1,3,0,8,10,10,30,1
+"""
+
+def write_ass(tmp_path, events, format_line="Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text", name="sub.ass"):
+    path = tmp_path / name
+    path.write_text("[Script Info]\nScriptType: v4.00+\n\n" + STYLES + "\n[Events]\n" + format_line + "\n" + "\n".join(events) + "\n", encoding="utf-8")
+    return str(path)
+
+def dialogue(start, end, text, style="Default"): return f"Dialogue: 0,{start},{end},{style},,0,0,0,,{text}"
+
+def event_tuples(track): return [(ev["start"], ev["end"], ev["style_name"], ev["text"]) for ev in track]
+
+def test_unsorted_events_are_sorted_stably(tmp_path):
+    path = write_ass(tmp_path, [dialogue("0:00:02.00", "0:00:03.00", "c"), dialogue("0:00:01.00", "0:00:02.00", "a"),
+                                dialogue("0:00:02.00", "0:00:02.50", "d", "Top"), dialogue("0:00:01.00", "0:00:01.50", "b")])
+    track, styles = main_cli.parse_ass_file(path)
+    assert set(styles) == {"Default", "Top"}
+    assert event_tuples(track) == [(1.0, 2.0, "Default", "a"), (1.0, 1.5, "Default", "b"), (2.0, 3.0, "Default", "c"), (2.0, 2.5, "Top", "d")]
+
+def test_commas_in_text_are_kept(tmp_path):
+    path = write_ass(tmp_path, [dialogue("0:00:00.00", "0:00:01.00", "{\\b1}раз, два,  три{\\b0}")])
+    track, _ = main_cli.parse_ass_file(path)
+    assert track[0]["text"] == "{\\b1}раз, два,  три{\\b0}" and track.plain_text(0) == "раз, два,  три"
+
+def test_custom_format_order(tmp_path):
+    path = write_ass(tmp_path, ["Dialogue: Top,0:00:04.00,0:00:01.50,0,x, y,z"], format_line="Format: Style, End, Start, Layer, Text")
+    track, _ = main_cli.parse_ass_file(path)
+    assert event_tuples(track) == [(1.5, 4.0, "Top", "x, y,z")]
+
+def test_count_before_and_max_duration_cut_off(tmp_path):
+    path = write_ass(tmp_path, [dialogue(f"0:00:{k:02d}.00", f"0:00:{k + 1:02d}.00", f"w{k}") for k in range(10)])
+    track, styles = main_cli.parse_ass_file(path)
+    assert track.count_before(0.0) == 0 and track.count_before(3.0) == 3 and track.count_before(3.5) == 4 and track.count_before(100.0) == 10
+    sources = [{"path": "a.mp4", "duration": 60.0, "fps": 30.0, "size": (640, 360)}]
+    plan = main_cli.build_montage_plan(track, styles, sources, max_allowed_duration=3.5, rng=main_cli.random.Random(1))
+    assert plan["events_used"] == 4 and plan["duration"] == 3.5
+    assert [seg["duration"] for seg in plan["segments"]] == [1.0, 1.0, 1.0, 0.5]
+
+def test_disk_cache_round_trip(tmp_path, monkeypatch):
+    path = write_ass(tmp_path, [dialogue("0:00:02.00", "0:00:03.00", "b, c", "Top"), dialogue("0:00:00.50", "0:00:02.00", "a")])
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(main_cli, "_PARSED_SUBTITLES_CACHE", main_cli.collections.OrderedDict())
+    track, styles = main_cli.load_subtitles_cached(path, cache_dir)
+    assert os.listdir(os.path.join(cache_dir, "subs"))
+    main_cli._PARSED_SUBTITLES_CACHE.clear()
+    monkeypatch.setattr(main_cli, "parse_ass_file", lambda filepath: (_ for _ in ()).throw(AssertionError("разбор вместо кэша")))
+    cached_track, cached_styles = main_cli.load_subtitles_cached(path, cache_dir)
+    assert event_tuples(cached_track) == event_tuples(track) and cached_styles == styles
+    assert cached_track.plain_text(1) == "b, c" and cached_track.count_before(1.0) == 1
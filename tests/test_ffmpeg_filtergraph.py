@@ -0,0 +1,30 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main_cli
+
+def test_split_piece_of_short_source_seeks_to_last_frame():
+    # Исходник 3 с под событием 0-5 с, поверх него событие 1-3.5 с: последний кусок первого сегмента начинается за концом исходника
+    plan = {"fps": 10, "size": [4, 4], "duration": 5.0, "texts": [], "segments": [
+        {"path": "short.mp4", "in": 0.0, "start": 0.0, "duration": 5.0, "source_duration": 3.0},
+        {"path": "long.mp4", "in": 0.0, "start": 1.0, "duration": 2.5, "source_duration": 10.0}]}
+    inputs, graph, _ = main_cli.build_ffmpeg_filtergraph(plan, "")
+    seeks = [(in_args[-1], float(in_args[1])) for in_args in inputs]
+    assert seeks == [("short.mp4", 0.0), ("long.mp4", 0.0), ("short.mp4", 2.9)]
+    assert "tpad=stop_mode=clone" in graph and "trim=end_frame=15" in graph
+
+def test_seek_picks_the_same_source_frame_as_ffmpeg_video_reader():
+    # Точка входа между кадрами исходника: ffmpeg -ss начал бы со следующего кадра, а ридер MoviePy берет кадр int(fps*t + 1e-5)
+    src_fps = 25.0
+    segments = [{"path": "a.mp4", "in": 3.017, "start": 0.0, "duration": 2.0, "source_duration": 30.0, "source_fps": src_fps},
+                {"path": "b.mp4", "in": 7.3999, "start": 2.0, "duration": 2.0, "source_duration": 30.0, "source_fps": src_fps}]
+    plan = {"fps": 30, "size": [4, 4], "duration": 4.0, "texts": [], "segments": segments}
+    inputs, _, _ = main_cli.build_ffmpeg_filtergraph(plan, "")
+    for in_args, seg in zip(inputs, segments):
+        n0 = math.ceil(seg["start"] * plan["fps"] - 1e-6)
+        reader_frame = int(src_fps * (seg["in"] + n0 / plan["fps"] - seg["start"]) + 0.00001) # FFMPEG_VideoReader.get_frame: pos - 1
+        seek = float(in_args[1])
+        assert abs(seek * src_fps - round(seek * src_fps)) < 1e-3 # Ровно на кадре: ffmpeg начнет с него же
+        assert round(seek * src_fps) == reader_frame
@@ -0,0 +1,79 @@
+import os
+import sys
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main_cli
+
+FPS = 10
+
+class StubReader:
+    # Как FFMPEG_VideoReader: pos - номер последнего прочитанного кадра, переход назад или далеко вперед - перезапуск
+    def __init__(self, path, log):
+        self.path, self.log, self.fps, self.pos = path, log, FPS, 1
+        self.log.append(("open", path))
+
+    def get_frame(self, t):
+        pos = int(self.fps * t + 0.00001) + 1
+        if pos < self.pos or pos > self.pos + 100: self.log.append(("restart", self.path))
+        self.pos = pos
+        return np.full((4, 4, 3), pos % 256, dtype=np.uint8)
+
+    def close(self): pass
+
+class StubReaderPool(main_cli.VideoReaderPool):
+    def __init__(self, max_open=main_cli.DEFAULT_MAX_OPEN_READERS):
+        super().__init__((4, 4), max_open); self.log = []
+
+    def _open_reader(self, path): return StubReader(path, self.log)
+
+def segment(path, start, duration, seg_in=0.0):
+    return {"path": path, "in": seg_in, "start": start, "duration": duration, "source_duration": 60.0}
+
+def composite_all_frames(prefetcher, segments, duration):
+    # Как CompositeVideoClip: на каждом кадре запрашиваются все идущие сегменты
+    for n in range(int(round(duration * FPS))):
+        t = n / FPS
+        for i, seg in enumerate(segments):
+            if seg["start"] <= t < seg["start"] + seg["duration"]:
+                frame = prefetcher.get_frame(i, t - seg["start"])
+                assert frame[0, 0, 0] == (int(FPS * prefetcher.source_time(i, t - seg["start"]) + 0.00001) + 1) % 256
+
+def run_with_timeout(func, timeout=10.0):
+    errors = []
+    def target():
+        try: func()
+        except BaseException as e: errors.append(e)
+    th = threading.Thread(target=target, daemon=True); th.start(); th.join(timeout)
+    assert not th.is_alive(), "композиция зависла"
+    if errors: raise errors[0]
+
+def test_overlapping_segments_do_not_hang():
+    segments = [segment("a.mp4", 0.0, 5.0), segment("b.mp4", 1.0, 1.0), segment("c.mp4", 2.0, 1.0), segment("d.mp4", 3.0, 1.0)]
+    pool = StubReaderPool(); prefetcher = main_cli.SegmentFramePrefetcher(pool, segments, FPS, n_threads=2, queue_size=16)
+    try: run_with_timeout(lambda: composite_all_frames(prefetcher, segments, 5.0))
+    finally: prefetcher.stop(); pool.close()
+
+def test_segments_of_one_source_keep_separate_read_positions():
+    # Два подряд идущих сегмента из одного файла в далеких друг от друга местах: предзагрузка второго не должна сбивать чтение первого
+    segments = [segment("a.mp4", 0.0, 3.0, seg_in=0.0), segment("a.mp4", 3.0, 3.0, seg_in=30.0)]
+    pool = StubReaderPool(); prefetcher = main_cli.SegmentFramePrefetcher(pool, segments, FPS, n_threads=2, queue_size=4)
+    try: run_with_timeout(lambda: composite_all_frames(prefetcher, segments, 6.0))
+    finally: prefetcher.stop(); pool.close()
+    assert pool.log.count(("restart", "a.mp4")) <= 2
+
+def test_reader_pool_respects_max_open():
+    pool = StubReaderPool(max_open=2)
+    for k in range(5): pool.get_frame(f"src_{k}.mp4", 0.0)
+    assert len(pool.readers) <= 2 and pool.opened_total == 5
+
+def test_reader_pool_reuses_idle_reader_when_busy_readers_fill_the_limit():
+    # Ридер a.mp4 занят (читает в другом потоке), ридер b.mp4 свободен, лимит 1: запрос далеко вперед по b.mp4 - seek в том же ридере
+    pool = StubReaderPool(max_open=1)
+    pool.readers[0] = ("a.mp4", StubReader("a.mp4", pool.log)); pool.busy.add(0)
+    pool.readers[1] = ("b.mp4", StubReader("b.mp4", pool.log)); pool._next_id = 2
+    frame = pool.get_frame("b.mp4", 50.0)
+    assert frame[0, 0, 0] == (int(FPS * 50.0 + 0.00001) + 1) % 256
+    assert [path for path, _ in pool.readers.values()].count("b.mp4") == 1
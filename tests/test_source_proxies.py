@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main_cli
+
+def make_sources(tmp_path):
+    infos = []
+    for k, size in enumerate([(1280, 720), (640, 360), (1920, 1080)]):
+        path = tmp_path / f"src_{k}.mp4"; path.write_bytes(b"x" * (k + 1))
+        infos.append({"path": str(path), "duration": 10.0, "fps": 30.0, "size": size, "codec": "h264"})
+    return infos
+
+def test_failed_proxy_keeps_source_order_and_target_profile(tmp_path, monkeypatch):
+    # Прокси первого исходника не создается: он остается первым (с оригинальным путем), а целевой профиль - от него же
+    made = []
+    def fake_make_source_proxy(path, proxy_path, target_size, target_fps):
+        made.append((os.path.basename(path), tuple(target_size), target_fps))
+        if not path.endswith("src_0.mp4"): open(proxy_path, 'wb').close()
+    monkeypatch.setattr(main_cli, "make_source_proxy", fake_make_source_proxy)
+    monkeypatch.setattr(main_cli, "probe_media_files", lambda paths, kind, cache=None, workers=1: [{"path": p, "duration": 10.0} for p in paths])
+    infos = make_sources(tmp_path); target = main_cli.target_video_profile(infos)
+    result = main_cli.prepare_source_proxies(infos, str(tmp_path / "cache"), target=target)
+    assert [info["path"] for info in result] == [info["path"] for info in infos]
+    assert "proxy_path" not in result[0] and all("proxy_path" in info for info in result[1:])
+    assert {size for _, size, _ in made} == {(1280, 720)}
+
+    class Events:
+        starts, ends, style_ids, text_ids, style_names, texts = [0.0], [1.0], [0], [0], ["Default"], ["x"]
+        def __len__(self): return 1
+        def count_before(self, t): return 1
+        def plain_text(self, idx): return "x"
+    plan = main_cli.build_montage_plan(Events(), {"Default": {}}, result, target=target)
+    assert plan["size"] == [1280, 720] and plan["fps"] == 30.0